@@ -0,0 +1,365 @@
+"""Benchmarks of the authentication classes against local stand-in Identity Providers
+
+The script starts, in-process, a JWT issuer publishing a JWKS of generated RSA
+keys and a Globus-style token introspection endpoint with configurable latency,
+and measures throughput and p50/p99 latency of JWTAuthentication,
+GlobusAuthentication and MultiproviderAuthentication in the following scenarios:
+
+cache_hit     the same valid token authenticated over and over
+db_hit        the same valid token found in the database, with the in-process cache disabled
+cold_miss     a new valid token in every request
+key_rotation  a new token signed with a freshly rotated key every few requests
+invalid_flood the same invalid token in every request
+
+Results are written as JSON, e.g.
+
+    python benchmarks/bench_auth.py --threads 1,8 --table-sizes 0,100000 --output bench.json
+"""
+import argparse
+import base64
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+SCENARIOS = ("cache_hit", "db_hit", "cold_miss", "key_rotation", "invalid_flood")
+BACKENDS = ("jwt", "globus", "multiprovider")
+AUDIENCE = "benchmark"
+ROTATE_EVERY = 50
+
+
+class IdentityProvider:
+    """Local JWT issuer and Globus-style introspection endpoint"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.keys = []
+        self.active_tokens = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = "http://127.0.0.1:{}/".format(self.server.server_port)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.rotate()
+
+    def handler(self):
+        idp = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, content, headers=()):
+                body = json.dumps(content).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                for header in headers:
+                    self.send_header(*header)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                time.sleep(idp.latency)
+                with idp.lock:
+                    keys = [jwk for _private_key, jwk in idp.keys]
+                self.send_json({"keys": keys}, [("Cache-Control", "max-age=3600")])
+
+            def do_POST(self):
+                time.sleep(idp.latency)
+                length = int(self.headers.get("Content-Length", 0))
+                token = parse_qs(self.rfile.read(length).decode()).get("token", [""])[0]
+                self.send_json(idp.active_tokens.get(token, {"active": False}))
+
+        return Handler
+
+    def rotate(self):
+        """Publish a new signing key next to the current one"""
+        from cryptography import x509
+        from cryptography.hazmat.primitives import hashes, serialization
+        from cryptography.hazmat.primitives.asymmetric import rsa
+        from cryptography.x509.oid import NameOID
+
+        kid = uuid.uuid4().hex
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, kid)])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (x509.CertificateBuilder()
+                .subject_name(name).issuer_name(name)
+                .public_key(private_key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+                .sign(private_key, hashes.SHA256()))
+        x5c = base64.b64encode(cert.public_bytes(serialization.Encoding.DER)).decode()
+        jwk = {"kid": kid, "alg": "RS256", "kty": "RSA", "x5c": [x5c]}
+        with self.lock:
+            self.keys = self.keys[-1:] + [(private_key, jwk)]
+
+    def jwt_token(self, sub="benchmark"):
+        import jwt
+        private_key, jwk = self.keys[-1]
+        claims = {"iss": self.url, "sub": sub, "aud": AUDIENCE, "exp": int(time.time()) + 3600,
+                  "jti": uuid.uuid4().hex}
+        token = jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": jwk["kid"], "typ": "JWT"})
+        return token.decode() if isinstance(token, bytes) else token
+
+    def opaque_token(self, sub="globus-benchmark"):
+        token = uuid.uuid4().hex
+        self.active_tokens[token] = {
+            "active": True, "sub": sub, "username": sub, "email": "", "name": "Bench Mark",
+            "aud": [AUDIENCE], "scope": "", "exp": int(time.time()) + 3600,
+        }
+        return token
+
+
+def setup_django(idp, db_path):
+    settings.configure(
+        SECRET_KEY="benchmark",
+        INSTALLED_APPS=["django.contrib.auth", "django.contrib.contenttypes", "rest_framework", "mp_auth"],
+        DATABASES={"default": {"ENGINE": "django.db.backends.sqlite3", "NAME": db_path,
+                               "OPTIONS": {"timeout": 60}}},
+        USE_TZ=True,
+        MULTIPROVIDER_AUTH={
+            "JWT": {idp.url: {"aud": AUDIENCE}},
+            "BearerTokens": {"globus": {"aud": AUDIENCE, "scope": []}},
+            "JWKS": {"min_refresh_interval": 0},
+        },
+        GLOBUS_CLIENT_ID="benchmark",
+        GLOBUS_CLIENT_SECRET="benchmark",
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command("migrate", verbosity=0)
+
+    from mp_auth.backends.globus import GlobusAuthentication
+    GlobusAuthentication.INTROSPECTION_URL = idp.url + "introspect"
+
+
+def fill_token_table(size):
+    """Fill the access token table with size unrelated tokens"""
+    from django.contrib.auth import get_user_model
+    from mp_auth.models import AccessToken, Provider, UserAssociation
+    from mp_auth.utils import token_digest
+
+    AccessToken.objects.all().delete()
+    if not size:
+        return
+    provider, _created = Provider.objects.get_or_create(iss="filler")
+    user, _created = get_user_model().objects.get_or_create(username="filler")
+    user_association, _created = UserAssociation.objects.get_or_create(
+            user=user, uid="filler", provider=provider)
+    exp = int(time.time()) + 3600
+    AccessToken.objects.bulk_create(
+        (AccessToken(user_association=user_association, access_token_hash=token_digest(uuid.uuid4().hex),
+                     scope="", exp=exp) for _i in range(size)),
+        batch_size=1000)
+
+
+def reset_caches():
+    from mp_auth.cache import DEFAULT_MAX_SIZE, get_negative_cache, get_token_cache
+    from mp_auth.writer import get_token_writer
+    get_token_writer().flush()
+    get_token_cache().clear()
+    get_token_cache().max_size = DEFAULT_MAX_SIZE
+    get_negative_cache().clear()
+
+
+def wait_for_token(token, timeout=10):
+    """Wait until the token validated by a request is written to the database"""
+    from mp_auth.models import AccessToken
+    from mp_auth.utils import token_digest
+    from mp_auth.writer import get_token_writer
+
+    get_token_writer().flush()
+    deadline = time.monotonic() + timeout
+    while not AccessToken.objects.filter(access_token_hash=token_digest(token)).exists():
+        if time.monotonic() > deadline:
+            raise RuntimeError("The token was not written to the database")
+        time.sleep(0.01)
+
+
+class Workload:
+    """Tokens of every request of a scenario
+
+    Tokens of the key_rotation scenario are signed when the request is made,
+    with a new key every ROTATE_EVERY requests, so that the JWKS served by
+    the stand-in issuer changes during the run.
+    """
+
+    def __init__(self, idp, backend, scenario, ops):
+        self.idp = idp
+        self.backend = backend
+        self.scenario = scenario
+        self.lock = threading.Lock()
+        if scenario in ("cache_hit", "db_hit"):
+            self.tokens = [self.new_token(0)] * ops
+        elif scenario == "invalid_flood":
+            if backend == "globus":
+                token = "invalid-" + uuid.uuid4().hex
+            else:
+                token = idp.jwt_token()[:-8] + "AAAAAAAA"
+            self.tokens = [token] * ops
+        elif scenario == "cold_miss":
+            self.tokens = [self.new_token(i) for i in range(ops)]
+        else:
+            self.tokens = None
+
+    def new_token(self, i):
+        if self.backend == "globus" or (self.backend == "multiprovider" and i % 2):
+            return self.idp.opaque_token()
+        return self.idp.jwt_token()
+
+    def token(self, i):
+        if self.tokens is not None:
+            return self.tokens[i]
+        if i % ROTATE_EVERY == 0:
+            with self.lock:
+                self.idp.rotate()
+        return self.new_token(i)
+
+
+def run(idp, backend, scenario, threads, ops):
+    from django.db import connections
+    from django.test import RequestFactory
+    from rest_framework.exceptions import AuthenticationFailed
+    from mp_auth.backends.globus import GlobusAuthentication
+    from mp_auth.backends.jwt import JWTAuthentication
+    from mp_auth.backends.mp import MultiproviderAuthentication
+
+    authentication_class = {
+        "jwt": JWTAuthentication,
+        "globus": GlobusAuthentication,
+        "multiprovider": MultiproviderAuthentication,
+    }[backend]
+    authentication = authentication_class()
+    factory = RequestFactory()
+    workload = Workload(idp, backend, scenario, ops)
+
+    # Warm the cache up with the token used by every request
+    if scenario in ("cache_hit", "db_hit"):
+        authentication.authenticate(factory.get("/", HTTP_AUTHORIZATION="Bearer " + workload.token(0)))
+    # Every request looks the token up in the access token table
+    if scenario == "db_hit":
+        from mp_auth.cache import get_token_cache
+        wait_for_token(workload.token(0))
+        get_token_cache().clear()
+        get_token_cache().max_size = 0
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def authenticate(i):
+        request = factory.get("/", HTTP_AUTHORIZATION="Bearer " + workload.token(i))
+        start = time.perf_counter()
+        try:
+            authentication.authenticate(request)
+        except AuthenticationFailed:
+            with lock:
+                errors[0] += 1
+        latency = time.perf_counter() - start
+        with lock:
+            latencies.append(latency)
+
+    def close_connections(_i):
+        connections.close_all()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(authenticate, range(ops)))
+        list(executor.map(close_connections, range(threads)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "backend": backend,
+        "scenario": scenario,
+        "threads": threads,
+        "ops": ops,
+        "errors": errors[0],
+        "elapsed_s": round(elapsed, 6),
+        "throughput_ops": round(ops / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))
+    return values[index]
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--backends", default=",".join(BACKENDS))
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--threads", type=int_list, default=[1, 4, 16])
+    parser.add_argument("--table-sizes", type=int_list, default=[0, 10000])
+    parser.add_argument("--ops", type=int, default=500, help="requests per run")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="latency of the stand-in Identity Providers in seconds")
+    parser.add_argument("--output", help="write JSON results to a file instead of stdout")
+    args = parser.parse_args()
+
+    idp = IdentityProvider(latency=args.latency)
+    db_dir = tempfile.mkdtemp(prefix="mp_auth_bench_")
+    setup_django(idp, os.path.join(db_dir, "bench.sqlite3"))
+
+    import mp_auth
+    results = []
+    for table_size in args.table_sizes:
+        fill_token_table(table_size)
+        for backend in args.backends.split(","):
+            for scenario in args.scenarios.split(","):
+                # Opaque tokens are not signed
+                if backend == "globus" and scenario == "key_rotation":
+                    continue
+                for threads in args.threads:
+                    reset_caches()
+                    result = run(idp, backend, scenario, threads, args.ops)
+                    result["table_size"] = table_size
+                    results.append(result)
+                    print("{backend:>13} {scenario:>13} threads={threads:<3} table={table_size:<7} "
+                          "{throughput_ops:>10.1f} ops/s p50={p50_ms:.3f}ms p99={p99_ms:.3f}ms "
+                          "errors={errors}".format(**result), file=sys.stderr)
+
+    report = {
+        "version": mp_auth.__version__,
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "idp_latency_s": args.latency,
+        "timestamp": int(time.time()),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+
+
+class MultiproviderAuthConfig(AppConfig):
+    name = "mp_auth"
+    verbose_name = "Multiprovider Authentication"
+    default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from .jwks import start_jwks_refresher
+        from .pruner import start_token_pruner
+        start_token_pruner()
+        start_jwks_refresher()
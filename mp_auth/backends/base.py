@@ -1,12 +1,82 @@
 import logging
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, connections, transaction
+from django.db.models import F
 from rest_framework import exceptions
 from rest_framework.authentication import get_authorization_header, BaseAuthentication
-from ..models import AccessToken
+from .. import metrics
+from ..cache import CachedToken, get_negative_cache, get_shared_cache, get_token_cache
+from ..exceptions import TransientAuthenticationFailed
+from ..models import AccessToken, UserAssociation
+from ..singleflight import AsyncSingleFlight, SingleFlight
+from ..utils import token_digest
+from ..writer import get_token_writer
 
 logger = logging.getLogger(__name__)
 
+UserModel = get_user_model()
+
+# Introspections in flight, shared by all authentication classes
+introspections = SingleFlight()
+async_introspections = AsyncSingleFlight()
+
+# Provider specific authentication classes by name
+backends = {}
+
+
+def register_backend(backend_class):
+    """Class decorator that makes a provider specific authentication class
+    available to MultiproviderAuthentication"""
+    backends[backend_class.name] = backend_class
+    return backend_class
+
+
+def get_issuer_backend(iss):
+    """Return an instance of the provider specific authentication class
+    that authenticates tokens of the issuer or None"""
+    for backend_class in backends.values():
+        backend = backend_class()
+        if iss in backend.get_issuers():
+            return backend
+    return None
+
+
+# Background re-introspections of stale cached tokens
+REVALIDATION_WORKERS = 4
+_revalidations = set()
+_revalidation_lock = threading.Lock()
+_revalidation_executor = None
+
+
+def get_revalidation_executor():
+    global _revalidation_executor
+    if _revalidation_executor is None:
+        with _revalidation_lock:
+            if _revalidation_executor is None:
+                _revalidation_executor = ThreadPoolExecutor(
+                        max_workers=REVALIDATION_WORKERS, thread_name_prefix="mp-auth-revalidation")
+    return _revalidation_executor
+
+
+def collect_audiences(rows):
+    """Merge rows of get_cached_tokens_query, one per audience of a token,
+    into a list of access tokens with their audiences set"""
+    access_tokens = {}
+    audiences = {}
+    for row in rows:
+        access_tokens.setdefault(row.pk, row)
+        if row.audience is not None:
+            audiences.setdefault(row.pk, []).append(row.audience)
+    for pk, access_token in access_tokens.items():
+        del access_token.audience
+        access_token.set_audiences(audiences.get(pk, ()))
+    return list(access_tokens.values())
+
 
 class MultiproviderBaseAuthentication(BaseAuthentication):
     """
@@ -15,12 +85,34 @@ class MultiproviderBaseAuthentication(BaseAuthentication):
     All provider authentication classes should derive from this class instead of
     rest_framework.authentication.BaseAuthentication
 
+    Provider specific classes set name and token_type ("jwt" or "opaque"),
+    implement get_issuers() and are registered with register_backend.
     """
 
+    name = None
+    token_type = None
+
     def __init__(self):
         self.jwt_idps = settings.MULTIPROVIDER_AUTH.get("JWT")
         self.opaque_token_idps = settings.MULTIPROVIDER_AUTH.get("BearerTokens")
 
+    def get_issuers(self):
+        """Return issuers configured in MULTIPROVIDER_AUTH whose tokens
+        this class authenticates"""
+        return []
+
+    def is_stateless(self, providers):
+        """Return True if all providers are JWT issuers configured with
+        "stateless": True, whose tokens are never stored in the database
+
+        Parameters
+        ----------
+        providers : list
+            providers specified in MULTIPROVIDER_AUTH dict in settings.py
+        """
+        jwt_idps = self.jwt_idps or {}
+        return all((jwt_idps.get(iss) or {}).get("stateless") for iss in providers)
+
     def get_token(self, request):
         """Extract a bearer token from the HTTP header"""
 
@@ -46,8 +138,98 @@ class MultiproviderBaseAuthentication(BaseAuthentication):
 
         return auth[1]
 
+    def coalesce_introspection(self, bearer_token):
+        """Introspect the token, sharing the result with concurrent
+        introspections of the same token by this provider
+
+        A token rejected by the provider is remembered in the negative cache
+        and rejected again without introspection until the entry expires.
+
+        Parameters
+        ----------
+        bearer_token : str
+            access token
+        """
+        key = (self.__class__.name, token_digest(bearer_token))
+        negative_cache = get_negative_cache()
+        reason = negative_cache.get(key)
+        if reason is not None:
+            metrics.increment("negative_cache_hit", self.__class__.name)
+            raise exceptions.AuthenticationFailed(reason)
+
+        try:
+            with metrics.timed("introspection_seconds", self.__class__.name):
+                result = introspections.do(key, self.introspect_token, bearer_token)
+        except TransientAuthenticationFailed:
+            metrics.increment("introspection", self.__class__.name, result="transient")
+            metrics.increment("failure", self.__class__.name, reason="transient")
+            raise
+        except exceptions.AuthenticationFailed as e:
+            negative_cache.set(key, str(e.detail))
+            metrics.increment("introspection", self.__class__.name, result="failure")
+            metrics.increment("failure", self.__class__.name, reason=str(e.detail))
+            raise
+        metrics.increment("introspection", self.__class__.name, result="success")
+        return result
+
+    async def acoalesce_introspection(self, bearer_token):
+        """Async counterpart of coalesce_introspection"""
+        key = (self.__class__.name, token_digest(bearer_token))
+        negative_cache = get_negative_cache()
+        reason = negative_cache.get(key)
+        if reason is not None:
+            metrics.increment("negative_cache_hit", self.__class__.name)
+            raise exceptions.AuthenticationFailed(reason)
+
+        try:
+            with metrics.timed("introspection_seconds", self.__class__.name):
+                result = await async_introspections.do(key, self.aintrospect_token, bearer_token)
+        except TransientAuthenticationFailed:
+            metrics.increment("introspection", self.__class__.name, result="transient")
+            metrics.increment("failure", self.__class__.name, reason="transient")
+            raise
+        except exceptions.AuthenticationFailed as e:
+            negative_cache.set(key, str(e.detail))
+            metrics.increment("introspection", self.__class__.name, result="failure")
+            metrics.increment("failure", self.__class__.name, reason=str(e.detail))
+            raise
+        metrics.increment("introspection", self.__class__.name, result="success")
+        return result
+
+    async def aintrospect_token(self, bearer_token):
+        """Async counterpart of introspect_token
+
+        Provider specific classes should override it with a non-blocking
+        implementation, by default introspect_token runs in a worker thread.
+        """
+        return await sync_to_async(self.introspect_token)(bearer_token)
+
+    def check_negative_cache(self, bearer_token, names):
+        """Return reasons the token was recently rejected for by all the
+        providers or None if any of them has not rejected it
+
+        Parameters
+        ----------
+        bearer_token : str
+            access token
+        names : list
+            names of authentication classes
+        """
+        digest = token_digest(bearer_token)
+        negative_cache = get_negative_cache()
+        reasons = []
+        for name in names:
+            reason = negative_cache.get((name, digest))
+            if reason is None:
+                return None
+            reasons.append(reason)
+        if reasons:
+            metrics.increment("negative_cache_hit", self.__class__.name)
+        return reasons
+
     def check_cache(self, access_token, providers):
-        """Look for the access token cached in the database
+        """Look for the access token in the in-process cache, in the cache
+        shared by all workers and then in the database
 
         Parameters
         ----------
@@ -60,14 +242,339 @@ class MultiproviderBaseAuthentication(BaseAuthentication):
         if isinstance(providers, str):
             providers = [providers]
 
+        token_cache = get_token_cache()
+        bearer_token = access_token
+        key = token_digest(bearer_token)
+        cached_token = token_cache.get(key)
+        if cached_token is not None:
+            if cached_token.iss in providers:
+                metrics.increment("cache_hit", self.__class__.name, tier="memory")
+                self.revalidate_if_stale(bearer_token, key, cached_token)
+                return cached_token.user, cached_token.access_token
+            metrics.increment("cache_miss", self.__class__.name)
+            return None, None
+
+        # Tokens of stateless issuers are kept in the in-process cache only
+        if self.is_stateless(providers):
+            metrics.increment("cache_miss", self.__class__.name)
+            return None, None
+
+        unix_time = int(time.time())
+        shared_cache = get_shared_cache()
+        if shared_cache is not None:
+            cached_token = shared_cache.get(key)
+            if cached_token is not None and cached_token.exp >= unix_time:
+                token_cache.set(key, cached_token, cached_token.exp)
+                if cached_token.iss in providers:
+                    metrics.increment("cache_hit", self.__class__.name, tier="shared")
+                    self.revalidate_if_stale(bearer_token, key, cached_token)
+                    return cached_token.user, cached_token.access_token
+                metrics.increment("cache_miss", self.__class__.name)
+                return None, None
+
+        with metrics.timed("cache_lookup_seconds", self.__class__.name):
+            access_tokens = self.get_cached_tokens(key, providers, unix_time)
+        if not access_tokens:
+            metrics.increment("cache_miss", self.__class__.name)
+            return None, None
+        access_token = access_tokens[0]
+
+        metrics.increment("cache_hit", self.__class__.name, tier="database")
+
+        user = access_token.user_association.user
+        iss = access_token.user_association.provider.iss
+        cached_token = CachedToken(user, access_token, iss, access_token.exp, access_token.validated_at or 0)
+        self.remember_token(key, cached_token)
+        self.revalidate_if_stale(bearer_token, key, cached_token)
+        return user, access_token
+
+    def get_cached_tokens(self, keys, providers, unix_time):
+        """Return a list of the unexpired access tokens with the digests
+        issued by one of the providers, with their users, providers and
+        audiences loaded by a single query, so that a token kept in the
+        caches is authorized without another query
+
+        Parameters
+        ----------
+        keys : str|list
+            digest or list of digests of access tokens
+        providers : list
+            providers specified in MULTIPROVIDER_AUTH dict in settings.py
+        unix_time : int
+            current time
+        """
+        return collect_audiences(self.get_cached_tokens_query(keys, providers, unix_time))
+
+    async def aget_cached_tokens(self, keys, providers, unix_time):
+        """Async counterpart of get_cached_tokens"""
+        query = self.get_cached_tokens_query(keys, providers, unix_time)
+        return collect_audiences([row async for row in query])
+
+    def get_cached_tokens_query(self, keys, providers, unix_time):
+        """Return a queryset of the tokens of get_cached_tokens with a row
+        per audience of a token, in its 'audience' attribute"""
+        if isinstance(keys, str):
+            keys = [keys]
+        return AccessToken.objects.select_related(
+                "user_association__provider", "user_association__user"
+        ).filter(
+                access_token_hash__in=keys,
+                exp__gte=unix_time,
+                resource_server__isnull=True,
+                user_association__provider__iss__in=list(providers)
+        ).annotate(audience=F("accesstokenaudience__aud"))
+
+    async def acheck_cache(self, access_token, providers):
+        """Async counterpart of check_cache"""
+        if isinstance(providers, str):
+            providers = [providers]
+
+        token_cache = get_token_cache()
+        bearer_token = access_token
+        key = token_digest(bearer_token)
+        cached_token = token_cache.get(key)
+        if cached_token is not None:
+            if cached_token.iss in providers:
+                metrics.increment("cache_hit", self.__class__.name, tier="memory")
+                self.revalidate_if_stale(bearer_token, key, cached_token)
+                return cached_token.user, cached_token.access_token
+            metrics.increment("cache_miss", self.__class__.name)
+            return None, None
+
+        # Tokens of stateless issuers are kept in the in-process cache only
+        if self.is_stateless(providers):
+            metrics.increment("cache_miss", self.__class__.name)
+            return None, None
+
+        unix_time = int(time.time())
+        shared_cache = get_shared_cache()
+        if shared_cache is not None:
+            cached_token = await shared_cache.aget(key)
+            if cached_token is not None and cached_token.exp >= unix_time:
+                token_cache.set(key, cached_token, cached_token.exp)
+                if cached_token.iss in providers:
+                    metrics.increment("cache_hit", self.__class__.name, tier="shared")
+                    self.revalidate_if_stale(bearer_token, key, cached_token)
+                    return cached_token.user, cached_token.access_token
+                metrics.increment("cache_miss", self.__class__.name)
+                return None, None
+
+        with metrics.timed("cache_lookup_seconds", self.__class__.name):
+            access_tokens = await self.aget_cached_tokens(key, providers, unix_time)
+        if not access_tokens:
+            metrics.increment("cache_miss", self.__class__.name)
+            return None, None
+        access_token = access_tokens[0]
+
+        metrics.increment("cache_hit", self.__class__.name, tier="database")
+
+        user = access_token.user_association.user
+        iss = access_token.user_association.provider.iss
+        cached_token = CachedToken(user, access_token, iss, access_token.exp, access_token.validated_at or 0)
+        token_cache.set(key, cached_token, cached_token.exp)
+        if shared_cache is not None:
+            await shared_cache.aset(key, cached_token, cached_token.exp)
+        self.revalidate_if_stale(bearer_token, key, cached_token)
+        return user, access_token
+
+    def verify_token(self, bearer_token):
+        """Check with the provider that a cached token is still valid, without
+        provisioning a user or storing the token. Raise AuthenticationFailed
+        if it is not.
+
+        Provider specific classes of revocable tokens should override it,
+        by default the token is introspected by introspect_token.
+        """
+        self.introspect_token(bearer_token)
+
+    def get_soft_ttl(self, iss):
+        """Return the number of seconds a cached token of the provider is
+        trusted without introspecting it again, or None if it is trusted
+        until it expires. Set by "soft_ttl" of the provider in
+        MULTIPROVIDER_AUTH["BearerTokens"]."""
+        idp = (self.opaque_token_idps or {}).get(iss)
+        return idp.get("soft_ttl") if idp else None
+
+    def revalidate_if_stale(self, bearer_token, key, cached_token):
+        """Introspect a cached token again in the background if it was
+        validated more than soft_ttl seconds ago
+
+        The cached token keeps being served while it is introspected.
+
+        Parameters
+        ----------
+        bearer_token : str
+            access token
+        key : str
+            digest of the access token
+        cached_token : CachedToken
+            cache entry of the token
+        """
+        soft_ttl = self.get_soft_ttl(cached_token.iss)
+        if not soft_ttl or time.time() - cached_token.validated_at < soft_ttl:
+            return
+        with _revalidation_lock:
+            if key in _revalidations:
+                return
+            _revalidations.add(key)
+        get_revalidation_executor().submit(self.revalidate, bearer_token, key, cached_token)
+
+    def revalidate(self, bearer_token, key, cached_token):
+        """Introspect a cached token again and evict it from all caches
+        if the provider rejects it, or mark it as validated now"""
+        try:
+            backend = get_issuer_backend(cached_token.iss)
+            if backend is None:
+                return
+            try:
+                with metrics.timed("introspection_seconds", backend.name):
+                    backend.verify_token(bearer_token)
+            except TransientAuthenticationFailed as e:
+                metrics.increment("introspection", backend.name, result="transient")
+                logger.warning("Could not revalidate a cached access token: {}".format(e.detail))
+                return
+            except exceptions.AuthenticationFailed as e:
+                metrics.increment("introspection", backend.name, result="failure")
+                metrics.increment("failure", backend.name, reason=str(e.detail))
+                logger.info("Cached access token of {} rejected: {}".format(cached_token.iss, e.detail))
+                get_negative_cache().set((backend.name, key), str(e.detail))
+                self.evict_token(key)
+                return
+            metrics.increment("introspection", backend.name, result="success")
+
+            # Keep the cached token and its database record, only the time
+            # of validation changes
+            cached_token.validated_at = int(time.time())
+            self.remember_token(key, cached_token)
+            AccessToken.objects.filter(access_token_hash=key).update(validated_at=cached_token.validated_at)
+        except Exception as e:
+            logger.warning("Error when revalidating a cached access token: {}".format(e))
+        finally:
+            with _revalidation_lock:
+                _revalidations.discard(key)
+            connections.close_all()
+
+    def evict_token(self, key):
+        """Remove a token from the in-process cache, the shared cache and
+        the database
+
+        Parameters
+        ----------
+        key : str
+            digest of the access token
+        """
+        get_token_cache().delete(key)
+        shared_cache = get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.delete(key)
+        AccessToken.objects.filter(access_token_hash=key, resource_server__isnull=True).delete()
+
+    def remember_token(self, key, cached_token):
+        """Keep a verified token in the in-process and the shared caches
+
+        Parameters
+        ----------
+        key : str
+            digest of the access token
+        cached_token : CachedToken
+            verified token
+        """
+        get_token_cache().set(key, cached_token, cached_token.exp)
+        shared_cache = get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.set(key, cached_token, cached_token.exp)
+
+    def cache_token(self, bearer_token, user, access_token, iss, exp):
+        """Keep a successfully introspected token in the in-process cache
+        and the shared cache
+
+        Parameters
+        ----------
+        bearer_token : str
+            access token
+        user : User
+            user the token was issued to
+        access_token : AccessToken
+            database record of the token or None
+        iss : str
+            provider that issued the token
+        exp : int
+            expiration time of the token
+        """
+        if not exp:
+            return
+        self.remember_token(token_digest(bearer_token), CachedToken(user, access_token, iss, int(exp)))
+
+    def store_token(self, bearer_token, user_association, iss, exp, scope=None, aud=None):
+        """Queue a successfully introspected token for writing to the database
+        and keep it in the in-process cache
+
+        Parameters
+        ----------
+        bearer_token : str
+            access token
+        user_association : UserAssociation
+            association of the user with the provider
+        iss : str
+            provider that issued the token
+        exp : int
+            expiration time of the token
+        scope : str
+            space separated scopes of the token
+        aud : str|list
+            audience or list of audiences of the token
+        """
+        if not exp:
+            return None
+        if isinstance(aud, str):
+            aud = [aud]
+        access_token = AccessToken(
+                user_association=user_association,
+                access_token_hash=token_digest(bearer_token),
+                scope=scope or "",
+                exp=exp,
+                validated_at=int(time.time()))
+        access_token.set_audiences(aud)
+        get_token_writer().put(access_token, aud or [])
+        self.cache_token(bearer_token, user_association.user, access_token, iss, exp)
+        return access_token
+
+    def get_or_create_user_association(self, provider, uid, **user_fields):
+        """Return the association of the provider's uid with a user, creating
+        the user if it does not exist. Safe against concurrent provisioning
+        of the same user.
+
+        Parameters
+        ----------
+        provider : Provider
+            provider the user authenticated with
+        uid : str
+            user id at the provider ('sub' claim)
+        user_fields : dict
+            fields of a user to be created
+        """
+        with metrics.timed("provisioning_seconds", self.__class__.name, issuer=provider.iss):
+            try:
+                return UserAssociation.objects.select_related("user", "provider").get(provider=provider, uid=uid)
+            except UserAssociation.DoesNotExist:
+                pass
+
+            return self.create_user_association(provider, uid, **user_fields)
+
+    def create_user_association(self, provider, uid, **user_fields):
+        """Create a user and its association with the provider's uid"""
         try:
-            access_token = AccessToken.objects.get(access_token=access_token)
-            unix_time = int(time.time())
-            if (access_token.exp >= unix_time and
-                    access_token.user_association.provider.iss in providers):
-                user = access_token.user_association.user
-                return user, access_token
-        except AccessToken.DoesNotExist:
-            pass
-
-        return None, None
+            with transaction.atomic():
+                user = UserModel.objects.create(**user_fields)
+                user_association = UserAssociation.objects.create(user=user, uid=uid, provider=provider)
+            logger.debug("New user '{}' created".format(user.username))
+            metrics.increment("user_provisioned", self.__class__.name, issuer=provider.iss)
+            return user_association
+        except IntegrityError as e:
+            # Another worker may have created the user in the meantime
+            try:
+                return UserAssociation.objects.select_related("user", "provider").get(provider=provider, uid=uid)
+            except UserAssociation.DoesNotExist:
+                logger.warning("Could not create a user for {}: {}".format(uid, e))
+                msg = "Could not create a user"
+                raise exceptions.AuthenticationFailed(msg)
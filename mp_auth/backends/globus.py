@@ -1,26 +1,39 @@
 import logging
 import time
-import requests
+from asgiref.sync import sync_to_async
 from django.conf import settings
-from django.contrib.auth import get_user_model
 from rest_framework import exceptions
-from ..models import Provider, UserAssociation, AccessToken
-from .base import MultiproviderBaseAuthentication
+from ..exceptions import TransientAuthenticationFailed
+from ..models import Provider
+from ..session import get_async_http_client, get_http_client
+from ..utils import get_scope_set
+from .base import MultiproviderBaseAuthentication, register_backend
 
 logger = logging.getLogger(__name__)
 
-UserModel = get_user_model()
-
 
+@register_backend
 class GlobusAuthentication(MultiproviderBaseAuthentication):
     name = "globus"
+    token_type = "opaque"
     INTROSPECTION_URL = "https://auth.globus.org/v2/oauth2/token/introspect"
     DEPENDENT_TOKEN_URL = "https://auth.globus.org/v2/oauth2/token"
+    DEPENDENT_TOKEN_GRANT_TYPE = "urn:globus:auth:grant_type:dependent_token"
+
+    def get_issuers(self):
+        if self.opaque_token_idps and self.opaque_token_idps.get("globus"):
+            return ["globus"]
+        return []
 
     def authenticate(self, request):
         # Extract a token from HTTP Authorization header
         bearer_token = self.get_token(request)
 
+        # Reject a token that was recently rejected
+        reasons = self.check_negative_cache(bearer_token, [self.__class__.name])
+        if reasons:
+            raise exceptions.AuthenticationFailed(reasons[0])
+
         # Authenticate against the database where access tokens are cached
         user, token = self.check_cache(bearer_token, self.__class__.name)
         if user:
@@ -28,7 +41,24 @@ class GlobusAuthentication(MultiproviderBaseAuthentication):
             return user, token
 
         # Introspect the token
-        user, token = self.introspect_token(bearer_token)
+        user, token = self.coalesce_introspection(bearer_token)
+        logger.info("{} successfully authenticated".format(user.username))
+        return user, token
+
+    async def aauthenticate(self, request):
+        """Async counterpart of authenticate"""
+        bearer_token = self.get_token(request)
+
+        reasons = self.check_negative_cache(bearer_token, [self.__class__.name])
+        if reasons:
+            raise exceptions.AuthenticationFailed(reasons[0])
+
+        user, token = await self.acheck_cache(bearer_token, self.__class__.name)
+        if user:
+            logger.info("{} successfully authenticated".format(user.username))
+            return user, token
+
+        user, token = await self.acoalesce_introspection(bearer_token)
         logger.info("{} successfully authenticated".format(user.username))
         return user, token
 
@@ -40,28 +70,91 @@ class GlobusAuthentication(MultiproviderBaseAuthentication):
            if it does not exist
         """
 
-        resp = requests.post(
-                GlobusAuthentication.INTROSPECTION_URL,
-                data={"token": bearer_token},
-                auth=(settings.GLOBUS_CLIENT_ID, settings.GLOBUS_CLIENT_SECRET)
-        )
+        content = self.verify_token(bearer_token)
+        return self.provision(bearer_token, content)
+
+    def verify_token(self, bearer_token):
+        """Introspect the token and return the introspection response if the
+        token is valid, without provisioning a user or storing the token"""
 
         try:
+            resp = get_http_client().post(
+                    GlobusAuthentication.INTROSPECTION_URL,
+                    data={"token": bearer_token},
+                    auth=(settings.GLOBUS_CLIENT_ID, settings.GLOBUS_CLIENT_SECRET)
+            )
+            resp.raise_for_status()
             content = resp.json()
         except Exception as e:
             logger.warning("Error when introspecting a bearer token: {}".format(e))
+            msg = "Could not introspect the token"
+            raise TransientAuthenticationFailed(msg)
+
+        self.check_introspection(content)
+        return content
+
+    async def aintrospect_token(self, bearer_token):
+        """Async counterpart of introspect_token"""
+
+        # httpx does not encode bytes in form data
+        token = bearer_token.decode() if isinstance(bearer_token, bytes) else bearer_token
+        try:
+            resp = await get_async_http_client().post(
+                    GlobusAuthentication.INTROSPECTION_URL,
+                    data={"token": token},
+                    auth=(settings.GLOBUS_CLIENT_ID, settings.GLOBUS_CLIENT_SECRET)
+            )
+            resp.raise_for_status()
+            content = resp.json()
+        except Exception as e:
+            logger.warning("Error when introspecting a bearer token: {}".format(e))
+            msg = "Could not introspect the token"
+            raise TransientAuthenticationFailed(msg)
+
+        self.check_introspection(content)
+        return await sync_to_async(self.provision)(bearer_token, content)
+
+    def exchange_dependent_tokens(self, bearer_token):
+        """Exchange the token for dependent tokens of the resource servers
+        the token's scopes depend on
+
+        Returns
+        -------
+        tokens : list
+            dicts with 'access_token', 'resource_server', 'scope' and
+            'expires_in' of the dependent tokens
+        """
+
+        token = bearer_token.decode() if isinstance(bearer_token, bytes) else bearer_token
+        try:
+            resp = get_http_client().post(
+                    GlobusAuthentication.DEPENDENT_TOKEN_URL,
+                    data={"grant_type": GlobusAuthentication.DEPENDENT_TOKEN_GRANT_TYPE, "token": token},
+                    auth=(settings.GLOBUS_CLIENT_ID, settings.GLOBUS_CLIENT_SECRET)
+            )
+            resp.raise_for_status()
+            content = resp.json()
+        except Exception as e:
+            logger.warning("Error when exchanging a bearer token for dependent tokens: {}".format(e))
+            msg = "Could not obtain dependent tokens"
+            raise TransientAuthenticationFailed(msg)
+
+        if not isinstance(content, list):
+            msg = "Invalid dependent token response"
+            raise exceptions.AuthenticationFailed(msg)
+        return content
+
+    def check_introspection(self, content):
+        """Check if the introspection response describes a valid token"""
 
         logger.debug("Introspection response: {}".format(content))
 
-        username = content.get("username")
         active = content.get("active")
         sub = content.get("sub")
         aud = content.get("aud")
-        email = content.get("email")
         scope = content.get("scope")
         exp = content.get("exp")
         nbf = content.get("nbf")
-        name = content.get("name")
 
         # Check if the token is active
         if not active:
@@ -77,15 +170,15 @@ class GlobusAuthentication(MultiproviderBaseAuthentication):
         # Check if the 'nbf' (Not Before) claim applies
         if nbf and int(nbf) > unix_time:
             msg = "Token cannot be used before {}".format(nbf)
-            raise exceptions.AuthenticationFailed(msg)
+            raise TransientAuthenticationFailed(msg)
 
         # Check if the 'aud' (Audience) claim applies
         if aud and not self.opaque_token_idps.get("globus").get("aud") in aud:
             msg = "Wrong audience of the token"
             raise exceptions.AuthenticationFailed(msg)
 
-        # Check if the 'scope' (Scope) claim applies
-        if scope and self.opaque_token_idps.get("globus").get("scope") in scope.split():
+        # Check if the token has all required scopes
+        if not get_scope_set(self.opaque_token_idps.get("globus").get("scope")) <= get_scope_set(scope):
             msg = "Wrong scope of the token"
             raise exceptions.AuthenticationFailed(msg)
 
@@ -93,27 +186,33 @@ class GlobusAuthentication(MultiproviderBaseAuthentication):
             msg = "Invalid introspection response"
             raise exceptions.AuthenticationFailed(msg)
 
+    def provision(self, bearer_token, content):
+        """Associate a valid token with an existing user or create a user
+        and store the token"""
+
+        username = content.get("username")
+        sub = content.get("sub")
+        aud = content.get("aud")
+        email = content.get("email")
+        scope = content.get("scope")
+        exp = content.get("exp")
+        name = content.get("name")
+
         provider, _created = Provider.objects.get_or_create(iss="globus")
 
-        try:
-            user_association = UserAssociation.objects.get(provider=provider, uid=sub)
-            user = user_association.user
-        except UserAssociation.DoesNotExist:
-            fullname, firstname, lastname = self.get_user_names(name)
-            user = UserModel.objects.create(
-                    first_name=firstname,
-                    last_name=lastname,
-                    email=email,
-                    username=username,
-            )
-            logger.debug("New user '{}' created".format(user.username))
-            user_association = UserAssociation.objects.create(
-                    user=user, uid=sub, provider=provider)
-            AccessToken.objects.create(
-                user_association=user_association, access_token=bearer_token, scope=scope, exp=exp)
-            logger.debug("New access token (Globus) {} added to the database".format(user.username))
-
-        return user, None
+        fullname, firstname, lastname = self.get_user_names(name)
+        user_association = self.get_or_create_user_association(
+                provider, sub,
+                first_name=firstname,
+                last_name=lastname,
+                email=email or "",
+                username=username,
+        )
+        user = user_association.user
+
+        access_token = self.store_token(bearer_token, user_association, "globus", exp, scope=scope, aud=aud)
+        logger.debug("New access token (Globus) of {} queued for the database".format(user.username))
+        return user, access_token
 
     def get_user_names(self, fullname="", first_name="", last_name=''):
         # Avoid None values
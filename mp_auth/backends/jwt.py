@@ -1,60 +1,204 @@
 import logging
 import time
-import requests
 import jwt
-from cryptography.x509 import load_pem_x509_certificate
-from cryptography.hazmat.backends import default_backend
-from django.contrib.auth import get_user_model
+from asgiref.sync import sync_to_async
 from rest_framework import exceptions
-from ..models import Provider, UserAssociation, AccessToken, JsonWebKey
-from .base import MultiproviderBaseAuthentication
+from .. import metrics
+from ..cache import CachedToken, get_token_cache
+from ..exceptions import TransientAuthenticationFailed
+from ..jwks import get_jwks_cache
+from ..models import Provider
+from ..utils import get_audience_set, get_scope_set, get_unverified_jwt, token_digest
+from .base import MultiproviderBaseAuthentication, register_backend
 
 logger = logging.getLogger(__name__)
 
-UserModel = get_user_model()
 
+class JWTPrincipal:
+    """Lightweight user authenticated with a JWT of a stateless issuer
 
+    The principal is built from verified claims without any database query.
+    A Django user is created or linked only when the view accesses the
+    principal's user or one of its attributes that is not defined here,
+    e.g. pk, email or groups.
+
+    Parameters
+    ----------
+    iss : str
+        issuer of the token
+    sub : str
+        subject of the token
+    claims : dict
+        verified claims of the token
+    """
+
+    __slots__ = ("iss", "sub", "claims", "_user")
+
+    is_authenticated = True
+    is_anonymous = False
+    is_active = True
+
+    def __init__(self, iss, sub, claims):
+        self.iss = iss
+        self.sub = sub
+        self.claims = claims
+        self._user = None
+
+    @property
+    def username(self):
+        return self.sub
+
+    @property
+    def scopes(self):
+        """Frozenset of scopes of the token"""
+        return get_scope_set(self.claims.get("scope"))
+
+    @property
+    def audiences(self):
+        """Frozenset of audiences of the token"""
+        return get_audience_set(self.claims.get("aud"))
+
+    @property
+    def user(self):
+        """Django user associated with the subject, created if it does not exist"""
+        if self._user is None:
+            provider, _created = Provider.objects.get_or_create(iss=self.iss)
+            user_association = JWTAuthentication().get_or_create_user_association(
+                    provider, self.sub, username=self.sub)
+            self._user = user_association.user
+        return self._user
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.user, name)
+
+    def __str__(self):
+        return self.sub
+
+    def __repr__(self):
+        return "<JWTPrincipal: {} ({})>".format(self.sub, self.iss)
+
+
+@register_backend
 class JWTAuthentication(MultiproviderBaseAuthentication):
     name = "jwt"
+    token_type = "jwt"
+
+    def get_issuers(self):
+        return list(self.jwt_idps or {})
 
     def authenticate(self, request):
         # Extract token from HTTP Authorization header
         bearer_token = self.get_token(request)
 
+        # Reject a token that was recently rejected
+        reasons = self.check_negative_cache(bearer_token, [self.__class__.name])
+        if reasons:
+            raise exceptions.AuthenticationFailed(reasons[0])
+
         # Authenticate against the database where old access tokens were stored
-        user, token = self.check_cache(bearer_token, self.jwt_idps.keys())
+        user, token = self.check_cache(bearer_token, self.get_token_issuers(bearer_token))
         if user:
             logger.info("{} successfully authenticated".format(user.username))
             return user, token
 
         # Introspect the token
-        user, token = self.introspect_token(bearer_token)
+        user, token = self.coalesce_introspection(bearer_token)
+        logger.info("{} successfully authenticated".format(user.username))
+        return user, token
+
+    async def aauthenticate(self, request):
+        """Async counterpart of authenticate"""
+        bearer_token = self.get_token(request)
+
+        reasons = self.check_negative_cache(bearer_token, [self.__class__.name])
+        if reasons:
+            raise exceptions.AuthenticationFailed(reasons[0])
+
+        user, token = await self.acheck_cache(bearer_token, self.get_token_issuers(bearer_token))
+        if user:
+            logger.info("{} successfully authenticated".format(user.username))
+            return user, token
+
+        user, token = await self.acoalesce_introspection(bearer_token)
         logger.info("{} successfully authenticated".format(user.username))
         return user, token
 
+    def get_token_issuers(self, bearer_token):
+        """Return the configured issuer of the token from its unverified
+        'iss' claim or, if the claim is missing or unknown, all issuers"""
+        _jwt_header, jwt_payload = get_unverified_jwt(bearer_token)
+        if jwt_payload:
+            iss = jwt_payload.get("iss")
+            if iss in self.jwt_idps:
+                return [iss]
+        return list(self.jwt_idps.keys())
+
     def introspect_token(self, bearer_token):
         """
         Introspect the token and, if the token is valid:
         1) store the token with user information in the database
         2) associate the token with an existing user or create a user
            if it does not exist
+        Tokens of issuers configured with "stateless": True are neither stored
+        nor associated with a user, a JWTPrincipal is returned instead.
         """
 
-        try:
-            jwt_header = jwt.get_unverified_header(bearer_token)
-        except Exception as e:
-            msg = "Error when decoding the JWT header: {}".format(e)
-            raise exceptions.AuthenticationFailed(msg)
+        jwt_header, jwt_payload, idp = self.check_claims(bearer_token)
+        iss = jwt_payload.get("iss")
 
-        try:
-            jwt_payload = jwt.decode(bearer_token, verify=False)
-        except Exception as e:
-            msg = "Error when decoding the JWT token payload: {}".format(e)
+        if idp.get("stateless"):
+            provider = Provider(iss=iss)
+        else:
+            provider, _created = Provider.objects.get_or_create(iss=iss)
+
+        # Get a corresponding public key from the JWKS cache
+        jwks_cache = get_jwks_cache()
+        public_key, key_alg = jwks_cache.get_public_key(provider, jwt_header.get("kid"))
+        self.verify_signature(bearer_token, jwt_header, jwt_payload, idp, public_key, key_alg)
+
+        if idp.get("stateless"):
+            return self.get_principal(bearer_token, jwt_payload)
+        return self.provision(bearer_token, provider, jwt_payload)
+
+    async def aintrospect_token(self, bearer_token):
+        """Async counterpart of introspect_token"""
+
+        jwt_header, jwt_payload, idp = self.check_claims(bearer_token)
+        iss = jwt_payload.get("iss")
+
+        if idp.get("stateless"):
+            provider = Provider(iss=iss)
+        else:
+            provider, _created = await Provider.objects.aget_or_create(iss=iss)
+
+        jwks_cache = get_jwks_cache()
+        public_key, key_alg = await jwks_cache.aget_public_key(provider, jwt_header.get("kid"))
+        self.verify_signature(bearer_token, jwt_header, jwt_payload, idp, public_key, key_alg)
+
+        if idp.get("stateless"):
+            return self.get_principal(bearer_token, jwt_payload)
+        return await sync_to_async(self.provision)(bearer_token, provider, jwt_payload)
+
+    def check_claims(self, bearer_token):
+        """Decode the JWT without verifying its signature and check its claims
+
+        Returns
+        -------
+        jwt_header : dict
+        jwt_payload : dict
+        idp : dict
+            issuer configuration from MULTIPROVIDER_AUTH in settings.py
+        """
+
+        jwt_header, jwt_payload = get_unverified_jwt(bearer_token)
+        if jwt_header is None:
+            msg = "Error when decoding the JWT token"
             raise exceptions.AuthenticationFailed(msg)
 
         typ = jwt_header.get("typ")
         alg = jwt_header.get("alg")
-        kid = jwt_header.get("kid")
 
         if typ != "JWT":
             msg = "Unsupported JWT token type"
@@ -92,57 +236,47 @@ class JWTAuthentication(MultiproviderBaseAuthentication):
         # Check if the 'nbf' (Not Before) claim applies
         if nbf and int(nbf) > unix_time:
             msg = "Token is not valid yet"
-            raise exceptions.AuthenticationFailed(msg)
+            raise TransientAuthenticationFailed(msg)
 
-        provider, _created = Provider.objects.get_or_create(iss=iss)
+        return jwt_header, jwt_payload, idp
 
-        # Try to get JWKS from the issuer server and update keys in the database
-        try:
-            resp = requests.get(iss + ".well-known/jwks.json")
-            jwks = resp.json()
-
-            for jwk in jwks.get("keys"):
-                kid = jwk.get("kid")
-                alg = jwk.get("alg")
-                kty = jwk.get("kty")
-                x5c = jwk.get("x5c")[0]
-                key, _created = JsonWebKey.objects.update_or_create(
-                    iss=provider,
-                    kid=kid,
-                    defaults={"alg": alg, "kty": kty, "x5c": x5c}
-                )
-        except Exception:
-            logger.warn("Could not download JWKS from {}".format(iss))
-
-        # Try to get a corresponding key from the database
-        try:
-            key = JsonWebKey.objects.get(kid=kid)
-        except JsonWebKey.DoesNotExist:
+    def verify_signature(self, bearer_token, jwt_header, jwt_payload, idp, public_key, key_alg):
+        """Verify the JWT with the public key of the corresponding JWK"""
+
+        if public_key is None:
             msg = "Could not obtain a corresponding JWK"
+            if get_jwks_cache().get_keyset(jwt_payload.get("iss")).last_error:
+                raise TransientAuthenticationFailed(msg)
             raise exceptions.AuthenticationFailed(msg)
 
-        # Verify the JWT token
-        cert_str = "-----BEGIN CERTIFICATE-----\n" + key.x5c + "\n-----END CERTIFICATE-----"
-        cert_obj = load_pem_x509_certificate(cert_str.encode(), default_backend())
         try:
-            jwt.decode(bearer_token, cert_obj.public_key(),
-                       audience=idp.get("aud"), algorithms=key.alg)
+            with metrics.timed("verification_seconds", self.__class__.name, issuer=jwt_payload.get("iss")):
+                jwt.decode(bearer_token, public_key,
+                           audience=idp.get("aud"), algorithms=[key_alg or jwt_header.get("alg")])
         except Exception as e:
             logger.debug("Error when verifying the JWT token: {}".format(e))
             raise exceptions.AuthenticationFailed(e)
 
-        try:
-            user_association = UserAssociation.objects.get(provider=provider, uid=sub)
-            user = user_association.user
-        except UserAssociation.DoesNotExist:
-            user = UserModel.objects.create(
-                    username=sub,
-            )
-            logger.debug("New user '{}' created".format(user.username))
-            user_association = UserAssociation.objects.create(
-                    user=user, uid=sub, provider=provider)
-            AccessToken.objects.create(
-                user_association=user_association, access_token=bearer_token, exp=exp)
-            logger.debug("New access token (JWT) '{}' added to the database".format(bearer_token))
-
-        return user, None
+    def get_principal(self, bearer_token, jwt_payload):
+        """Return a principal built from the claims of a verified token and
+        keep it in the in-process cache"""
+
+        iss = jwt_payload.get("iss")
+        principal = JWTPrincipal(iss, jwt_payload.get("sub"), jwt_payload)
+        exp = jwt_payload.get("exp")
+        if exp:
+            get_token_cache().set(token_digest(bearer_token), CachedToken(principal, None, iss, int(exp)), int(exp))
+        return principal, None
+
+    def provision(self, bearer_token, provider, jwt_payload):
+        """Associate a verified token with an existing user or create a user
+        and store the token"""
+
+        sub = jwt_payload.get("sub")
+        user_association = self.get_or_create_user_association(provider, sub, username=sub)
+        user = user_association.user
+
+        access_token = self.store_token(bearer_token, user_association, provider.iss, jwt_payload.get("exp"),
+                                        scope=jwt_payload.get("scope"), aud=jwt_payload.get("aud"))
+        logger.debug("New access token (JWT) of {} queued for the database".format(user.username))
+        return user, access_token
@@ -1,46 +1,148 @@
+import asyncio
 import logging
+import threading
 from rest_framework.exceptions import AuthenticationFailed
-from .base import MultiproviderBaseAuthentication
-from .globus import GlobusAuthentication
-from .jwt import JWTAuthentication
+from ..utils import get_unverified_jwt
+from .base import MultiproviderBaseAuthentication, backends
+from .globus import GlobusAuthentication  # noqa: F401
+from .jwt import JWTAuthentication  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
 
+class Router:
+    """Routing table from tokens to provider specific authentication classes
+
+    The table is built once from MULTIPROVIDER_AUTH in settings.py and all
+    registered authentication classes. JWTs are routed by their unverified
+    'iss' claim to the class that handles the issuer, opaque tokens to all
+    classes of opaque tokens.
+    """
+
+    def __init__(self):
+        self.jwt_backends = {}
+        self.opaque_backends = []
+        for backend_class in backends.values():
+            backend = backend_class()
+            issuers = backend.get_issuers()
+            if not issuers:
+                continue
+            if backend.token_type == "jwt":
+                for iss in issuers:
+                    self.jwt_backends[iss] = backend
+            else:
+                self.opaque_backends.append((backend, issuers))
+
+    def route(self, bearer_token):
+        """Return a list of (authentication class instance, issuers) that
+        can authenticate the token
+
+        Parameters
+        ----------
+        bearer_token : str
+            access token
+        """
+        jwt_header, jwt_payload = get_unverified_jwt(bearer_token)
+        if jwt_header is None:
+            return self.opaque_backends
+
+        iss = jwt_payload.get("iss")
+        backend = self.jwt_backends.get(iss)
+        if backend is None:
+            return []
+        return [(backend, [iss])]
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router():
+    """Return the process-wide routing table"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = Router()
+    return _router
+
+
 class MultiproviderAuthentication(MultiproviderBaseAuthentication):
 
     def authenticate(self, request):
         """Authenticate the request against the database with cached access tokens
         received with previous successfully authenticated requests. If the requests
-        contains a new access toke, introspect the token in a sequence by provider
-        specific authentication classes.
+        contains a new access toke, introspect the token by the provider specific
+        authentication classes the token is routed to.
         """
 
         bearer_token = self.get_token(request)
+
+        candidates = get_router().route(bearer_token)
+        if not candidates:
+            msg = "No provider can authenticate the token"
+            raise AuthenticationFailed(msg)
+
+        # Reject a token that was recently rejected by all providers
+        reasons = self.check_negative_cache(bearer_token, [backend.name for backend, _issuers in candidates])
+        if reasons:
+            raise AuthenticationFailed('. Or: '.join(reasons))
+
         user, token = self.check_cache(
                 bearer_token,
-                list(self.jwt_idps.keys()) + list(self.opaque_token_idps.keys()))
+                [iss for _backend, issuers in candidates for iss in issuers])
         if user:
             return user, token
 
         exception_list = []
 
-        if self.jwt_idps:
+        for backend, _issuers in candidates:
             try:
-                jwt_authentication = JWTAuthentication()
-                user, token = jwt_authentication.introspect_token(bearer_token)
-                return user, None
+                user, token = backend.coalesce_introspection(bearer_token)
+                return user, token
             except AuthenticationFailed as e:
                 exception_list.append(e)
 
-        if self.opaque_token_idps:
-            if self.opaque_token_idps.get("globus"):
+        msg = '. Or: '.join([str(ex) for ex in exception_list])
+        raise AuthenticationFailed(msg)
+
+    async def aauthenticate(self, request):
+        """Async counterpart of authenticate. New access tokens are introspected
+        concurrently by all provider specific authentication classes the token
+        is routed to and the first successful introspection wins.
+        """
+
+        bearer_token = self.get_token(request)
+
+        candidates = get_router().route(bearer_token)
+        if not candidates:
+            msg = "No provider can authenticate the token"
+            raise AuthenticationFailed(msg)
+
+        reasons = self.check_negative_cache(bearer_token, [backend.name for backend, _issuers in candidates])
+        if reasons:
+            raise AuthenticationFailed('. Or: '.join(reasons))
+
+        user, token = await self.acheck_cache(
+                bearer_token,
+                [iss for _backend, issuers in candidates for iss in issuers])
+        if user:
+            return user, token
+
+        exception_list = []
+
+        tasks = [asyncio.ensure_future(backend.acoalesce_introspection(bearer_token))
+                 for backend, _issuers in candidates]
+        try:
+            for task in asyncio.as_completed(tasks):
                 try:
-                    globus_authentication = GlobusAuthentication()
-                    user, token = globus_authentication.introspect_token(bearer_token)
-                    return user, None
+                    user, token = await task
+                    return user, token
                 except AuthenticationFailed as e:
                     exception_list.append(e)
+        finally:
+            for task in tasks:
+                task.cancel()
 
         msg = '. Or: '.join([str(ex) for ex in exception_list])
         raise AuthenticationFailed(msg)
@@ -0,0 +1,248 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.db import connections
+from rest_framework.exceptions import AuthenticationFailed
+from . import metrics
+from .backends.base import MultiproviderBaseAuthentication
+from .backends.mp import get_router
+from .cache import CachedToken, get_shared_cache, get_token_cache
+from .exceptions import TransientAuthenticationFailed
+from .jwks import get_jwks_cache
+from .models import Provider
+from .utils import get_unverified_jwt, token_digest
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class TokenResult:
+    """Result of validation of a single access token
+
+    Attributes
+    ----------
+    user : User
+        user the token was issued to, None if the token is not valid
+    access_token : AccessToken
+        database record of the token or None
+    error : AuthenticationFailed
+        reason the token was rejected, None if the token is valid
+    """
+
+    __slots__ = ("user", "access_token", "error")
+
+    def __init__(self, user=None, access_token=None, error=None):
+        self.user = user
+        self.access_token = access_token
+        self.error = error
+
+    @property
+    def valid(self):
+        return self.error is None and self.user is not None
+
+    def __repr__(self):
+        if self.valid:
+            return "<TokenResult: {}>".format(self.user)
+        return "<TokenResult: {}>".format(self.error)
+
+
+def validate_tokens(tokens, max_workers=DEFAULT_MAX_WORKERS):
+    """Validate many access tokens at once, as MultiproviderAuthentication
+    would validate each of them
+
+    Duplicate tokens are validated once. Tokens found in the in-process
+    cache, the shared cache or the database are resolved with a single
+    lookup per tier. The remaining JWTs are verified grouped by issuer and
+    key id, so that every key is loaded once, and the remaining opaque
+    tokens are introspected concurrently by up to max_workers threads.
+
+    Parameters
+    ----------
+    tokens : list
+        access tokens (str or bytes)
+    max_workers : int
+        maximum number of concurrent introspections of opaque tokens
+
+    Returns
+    -------
+    results : dict
+        TokenResult by token
+    """
+    router = get_router()
+    auth = MultiproviderBaseAuthentication()
+    digests = {}
+    results = {}
+    pending = {}
+    for token in tokens:
+        if token in digests:
+            continue
+        digest = digests[token] = token_digest(token)
+        if digest in results or digest in pending:
+            continue
+
+        candidates = router.route(token)
+        if not candidates:
+            msg = "No provider can authenticate the token"
+            results[digest] = TokenResult(error=AuthenticationFailed(msg))
+            continue
+
+        reasons = auth.check_negative_cache(token, [backend.name for backend, _issuers in candidates])
+        if reasons:
+            results[digest] = TokenResult(error=AuthenticationFailed('. Or: '.join(reasons)))
+            continue
+
+        pending[digest] = (token, candidates)
+
+    resolve_cached_tokens(auth, pending, results)
+
+    jwt_groups = {}
+    opaque_tokens = []
+    for digest, (token, _candidates) in pending.items():
+        jwt_header, jwt_payload = get_unverified_jwt(token)
+        if jwt_header is None:
+            opaque_tokens.append(digest)
+        else:
+            jwt_groups.setdefault((jwt_payload.get("iss"), jwt_header.get("kid")), []).append(digest)
+
+    # Signature verification is CPU-bound, JWTs are verified in the calling
+    # thread. The key of a group is loaded once, before its tokens are verified.
+    for (iss, kid), group in jwt_groups.items():
+        error = load_jwt_key(router, iss, kid)
+        for digest in group:
+            if error is not None:
+                results[digest] = TokenResult(error=error)
+            else:
+                results[digest] = introspect_token(*pending[digest])
+
+    if opaque_tokens:
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(opaque_tokens))) as executor:
+            futures = {digest: executor.submit(introspect_token_in_worker, *pending[digest])
+                       for digest in opaque_tokens}
+            for digest, future in futures.items():
+                results[digest] = future.result()
+
+    return {token: results[digest] for token, digest in digests.items()}
+
+
+def resolve_cached_tokens(auth, pending, results):
+    """Move tokens found in the in-process cache, the shared cache or the
+    database from pending to results
+
+    Parameters
+    ----------
+    auth : MultiproviderBaseAuthentication
+        authentication class used to cache the tokens
+    pending : dict
+        (token, candidates) by digest of tokens to be validated
+    results : dict
+        TokenResult by digest of validated tokens
+    """
+    issuers = {digest: [iss for _backend, issuers in candidates for iss in issuers]
+               for digest, (_token, candidates) in pending.items()}
+
+    token_cache = get_token_cache()
+    lookup = []
+    for digest in pending:
+        cached_token = token_cache.get(digest)
+        if cached_token is None:
+            # Tokens of stateless issuers are kept in the in-process cache only
+            if not auth.is_stateless(issuers[digest]):
+                lookup.append(digest)
+        elif cached_token.iss in issuers[digest]:
+            results[digest] = TokenResult(cached_token.user, cached_token.access_token)
+            metrics.increment("cache_hit", None, tier="memory")
+            auth.revalidate_if_stale(pending[digest][0], digest, cached_token)
+
+    unix_time = int(time.time())
+    shared_cache = get_shared_cache()
+    if shared_cache is not None and lookup:
+        found = set()
+        for digest, cached_token in shared_cache.get_many(lookup).items():
+            if cached_token.exp < unix_time:
+                continue
+            found.add(digest)
+            token_cache.set(digest, cached_token, cached_token.exp)
+            if cached_token.iss in issuers[digest]:
+                results[digest] = TokenResult(cached_token.user, cached_token.access_token)
+                metrics.increment("cache_hit", None, tier="shared")
+                auth.revalidate_if_stale(pending[digest][0], digest, cached_token)
+        lookup = [digest for digest in lookup if digest not in found]
+
+    if lookup:
+        with metrics.timed("cache_lookup_seconds", None):
+            access_tokens = auth.get_cached_tokens(
+                    lookup, {iss for digest in lookup for iss in issuers[digest]}, unix_time)
+        for access_token in access_tokens:
+            digest = access_token.access_token_hash
+            user = access_token.user_association.user
+            iss = access_token.user_association.provider.iss
+            if iss not in issuers[digest]:
+                continue
+            cached_token = CachedToken(user, access_token, iss, access_token.exp, access_token.validated_at or 0)
+            auth.remember_token(digest, cached_token)
+            results[digest] = TokenResult(user, access_token)
+            metrics.increment("cache_hit", None, tier="database")
+            auth.revalidate_if_stale(pending[digest][0], digest, cached_token)
+
+    for digest in list(pending):
+        if digest in results:
+            del pending[digest]
+        else:
+            metrics.increment("cache_miss", None)
+
+
+def load_jwt_key(router, iss, kid):
+    """Load the key of JWTs of the issuer signed with the key id into the
+    JWKS cache
+
+    Returns
+    -------
+    error : AuthenticationFailed
+        reason all the JWTs are rejected for or None
+    """
+    backend = router.jwt_backends.get(iss)
+    if backend is None:
+        # Rejected by the claims check of every token
+        return None
+    try:
+        if backend.jwt_idps[iss].get("stateless"):
+            provider = Provider(iss=iss)
+        else:
+            provider, _created = Provider.objects.get_or_create(iss=iss)
+        public_key, _key_alg = get_jwks_cache().get_public_key(provider, kid)
+    except TransientAuthenticationFailed as e:
+        return e
+    except Exception as e:
+        logger.warning("Error when loading JWK {} of {}: {}".format(kid, iss, e))
+        return TransientAuthenticationFailed("Could not obtain a corresponding JWK")
+    if public_key is None:
+        msg = "Could not obtain a corresponding JWK"
+        if get_jwks_cache().get_keyset(iss).last_error:
+            return TransientAuthenticationFailed(msg)
+        return AuthenticationFailed(msg)
+    return None
+
+
+def introspect_token(token, candidates):
+    """Introspect the token by the authentication classes it is routed to"""
+    errors = []
+    for backend, _issuers in candidates:
+        try:
+            user, access_token = backend.coalesce_introspection(token)
+            return TokenResult(user, access_token)
+        except AuthenticationFailed as e:
+            errors.append(e)
+        except Exception as e:
+            logger.warning("Error when validating a token: {}".format(e))
+            errors.append(AuthenticationFailed("Could not validate the token"))
+    if len(errors) == 1:
+        return TokenResult(error=errors[0])
+    return TokenResult(error=AuthenticationFailed('. Or: '.join([str(e) for e in errors])))
+
+
+def introspect_token_in_worker(token, candidates):
+    try:
+        return introspect_token(token, candidates)
+    finally:
+        connections.close_all()
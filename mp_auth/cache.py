@@ -0,0 +1,220 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 10000
+DEFAULT_NEGATIVE_TTL = 30
+DEFAULT_SHARED_CACHE_ALIAS = "default"
+DEFAULT_SHARED_CACHE_KEY_PREFIX = "mp_auth:token:"
+
+
+class CachedToken:
+    """A verified access token kept in the in-process cache"""
+
+    __slots__ = ("user", "access_token", "iss", "exp", "validated_at")
+
+    def __init__(self, user, access_token, iss, exp, validated_at=None):
+        self.user = user
+        self.access_token = access_token
+        self.iss = iss
+        self.exp = exp
+        # Unix time the token was last introspected
+        self.validated_at = int(time.time()) if validated_at is None else validated_at
+
+
+class TokenCache:
+    """Thread-safe, size-bounded in-process cache
+
+    Entries are evicted when they expire or, when the cache is full, in
+    least-recently-used order.
+
+    Parameters
+    ----------
+    max_size : int
+        maximum number of entries kept in the cache
+    ttl : int
+        optional upper bound (in seconds) on the lifetime of an entry
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, exp=None):
+        """Store a value until the Unix time exp (or ttl seconds, whichever comes first)"""
+        if self.max_size <= 0:
+            return
+        expires = float("inf") if exp is None else int(exp)
+        if self.ttl is not None:
+            expires = min(expires, time.time() + self.ttl)
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SharedTokenCache:
+    """Cache of verified access tokens shared by all workers through
+    Django's cache framework
+
+    Entries are stored with a timeout equal to the remaining lifetime of
+    the token. Errors of the cache backend are logged and treated as
+    cache misses.
+
+    Parameters
+    ----------
+    alias : str
+        alias of a cache configured in CACHES in settings.py
+    key_prefix : str
+        prefix of cache keys
+    """
+
+    def __init__(self, alias=DEFAULT_SHARED_CACHE_ALIAS, key_prefix=DEFAULT_SHARED_CACHE_KEY_PREFIX):
+        self.alias = alias
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        try:
+            return caches[self.alias].get(self.key_prefix + key)
+        except Exception as e:
+            logger.warning("Could not get a token from the shared cache: {}".format(e))
+            return None
+
+    def get_many(self, keys):
+        """Return cached tokens by key for the keys found in the cache"""
+        try:
+            values = caches[self.alias].get_many([self.key_prefix + key for key in keys])
+        except Exception as e:
+            logger.warning("Could not get tokens from the shared cache: {}".format(e))
+            return {}
+        return {key[len(self.key_prefix):]: value for key, value in values.items()}
+
+    def set(self, key, value, exp):
+        timeout = int(exp - time.time())
+        if timeout <= 0:
+            return
+        try:
+            caches[self.alias].set(self.key_prefix + key, value, timeout)
+        except Exception as e:
+            logger.warning("Could not store a token in the shared cache: {}".format(e))
+
+    async def aget(self, key):
+        try:
+            return await caches[self.alias].aget(self.key_prefix + key)
+        except Exception as e:
+            logger.warning("Could not get a token from the shared cache: {}".format(e))
+            return None
+
+    async def aset(self, key, value, exp):
+        timeout = int(exp - time.time())
+        if timeout <= 0:
+            return
+        try:
+            await caches[self.alias].aset(self.key_prefix + key, value, timeout)
+        except Exception as e:
+            logger.warning("Could not store a token in the shared cache: {}".format(e))
+
+    def delete(self, key):
+        try:
+            caches[self.alias].delete(self.key_prefix + key)
+        except Exception as e:
+            logger.warning("Could not delete a token from the shared cache: {}".format(e))
+
+
+_token_cache = None
+_token_cache_lock = threading.Lock()
+
+
+def get_token_cache():
+    """Return the process-wide cache of verified access tokens
+
+    The cache is configured by the optional "Cache" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "Cache": {"max_size": 10000, "ttl": 3600}
+    """
+    global _token_cache
+    if _token_cache is None:
+        with _token_cache_lock:
+            if _token_cache is None:
+                conf = settings.MULTIPROVIDER_AUTH.get("Cache", {})
+                _token_cache = TokenCache(
+                        max_size=conf.get("max_size", DEFAULT_MAX_SIZE),
+                        ttl=conf.get("ttl"))
+    return _token_cache
+
+
+_negative_cache = None
+
+
+def get_negative_cache():
+    """Return the process-wide cache of rejected access tokens
+
+    Entries map (provider, token digest) to the reason the token was rejected.
+    The cache is configured by the optional "NegativeCache" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "NegativeCache": {"max_size": 10000, "ttl": 30}
+    """
+    global _negative_cache
+    if _negative_cache is None:
+        with _token_cache_lock:
+            if _negative_cache is None:
+                conf = settings.MULTIPROVIDER_AUTH.get("NegativeCache", {})
+                _negative_cache = TokenCache(
+                        max_size=conf.get("max_size", DEFAULT_MAX_SIZE),
+                        ttl=conf.get("ttl", DEFAULT_NEGATIVE_TTL))
+    return _negative_cache
+
+
+_shared_cache = None
+
+
+def get_shared_cache():
+    """Return the cache of verified access tokens shared by all workers or
+    None if it is not configured
+
+    The cache is enabled by the optional "SharedCache" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "SharedCache": {"alias": "default", "key_prefix": "mp_auth:token:"}
+    """
+    global _shared_cache
+    if _shared_cache is None:
+        conf = settings.MULTIPROVIDER_AUTH.get("SharedCache")
+        if conf is None:
+            return None
+        with _token_cache_lock:
+            if _shared_cache is None:
+                _shared_cache = SharedTokenCache(
+                        alias=conf.get("alias", DEFAULT_SHARED_CACHE_ALIAS),
+                        key_prefix=conf.get("key_prefix", DEFAULT_SHARED_CACHE_KEY_PREFIX))
+    return _shared_cache
@@ -0,0 +1,246 @@
+import base64
+import hashlib
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography.fernet import Fernet, InvalidToken
+from django.conf import settings
+from django.db import connections
+from rest_framework import exceptions
+from .backends.base import MultiproviderBaseAuthentication
+from .backends.globus import GlobusAuthentication
+from .cache import DEFAULT_MAX_SIZE, TokenCache
+from .models import AccessToken, UserAssociation
+from .singleflight import SingleFlight
+from .utils import token_digest
+from .writer import get_token_writer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REFRESH_AHEAD = 300
+DEFAULT_MIN_LIFETIME = 60
+REFRESH_WORKERS = 4
+
+_refresh_executor = None
+_refresh_executor_lock = threading.Lock()
+
+
+def get_refresh_executor():
+    global _refresh_executor
+    if _refresh_executor is None:
+        with _refresh_executor_lock:
+            if _refresh_executor is None:
+                _refresh_executor = ThreadPoolExecutor(
+                        max_workers=REFRESH_WORKERS, thread_name_prefix="mp-auth-dependent-refresh")
+    return _refresh_executor
+
+
+def get_fernet():
+    """Return the cipher of dependent tokens stored in the database, with
+    a key derived from SECRET_KEY"""
+    key = hashlib.sha256(("mp_auth.dependent:" + settings.SECRET_KEY).encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def encrypt_token(token):
+    return get_fernet().encrypt(token.encode()).decode()
+
+
+def decrypt_token(value):
+    """Return a decrypted dependent token or None if it cannot be decrypted,
+    e.g. because SECRET_KEY has changed"""
+    try:
+        return get_fernet().decrypt(value.encode()).decode()
+    except (InvalidToken, ValueError, AttributeError):
+        return None
+
+
+class DependentToken:
+    """Dependent access token of a user for a resource server"""
+
+    __slots__ = ("access_token", "resource_server", "scope", "exp")
+
+    def __init__(self, access_token, resource_server, scope, exp):
+        self.access_token = access_token
+        self.resource_server = resource_server
+        self.scope = scope
+        self.exp = exp
+
+
+class DependentTokenCache:
+    """Cache of Globus dependent tokens per user and resource server
+
+    A token is exchanged for dependent tokens once, however many downstream
+    calls need them. The dependent tokens are kept in memory and stored,
+    encrypted with a key derived from SECRET_KEY, in the database, so that
+    other workers reuse them. They are used until min_lifetime seconds
+    before they expire. A token requested within refresh_ahead seconds
+    before its expiration is returned and exchanged again in the background.
+    A resource server Globus did not issue a dependent token for is not
+    requested again until the next exchange.
+
+    Parameters
+    ----------
+    max_size : int
+        maximum number of dependent tokens kept in memory
+    refresh_ahead : int
+        number of seconds before expiration dependent tokens are refreshed
+    min_lifetime : int
+        minimum remaining lifetime (in seconds) of a returned dependent token
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, refresh_ahead=DEFAULT_REFRESH_AHEAD,
+                 min_lifetime=DEFAULT_MIN_LIFETIME):
+        self.refresh_ahead = refresh_ahead
+        self.min_lifetime = min_lifetime
+        self._tokens = TokenCache(max_size)
+        # Resource servers of the last exchange by user
+        self._issued = TokenCache(max_size)
+        self._exchanges = SingleFlight()
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def get_token(self, user, bearer_token, resource_server):
+        """Return a dependent access token of the user for the resource server
+        or None if Globus did not issue one
+
+        Parameters
+        ----------
+        user : User
+            user authenticated with the bearer token
+        bearer_token : str
+            Globus access token of the user
+        resource_server : str
+            resource server of the dependent token, e.g. 'transfer.api.globus.org'
+        """
+        key = (user.pk, resource_server)
+        dependent_token = self._tokens.get(key)
+        if dependent_token is None:
+            issued = self._issued.get(user.pk)
+            if issued is not None and resource_server not in issued:
+                return None
+            if issued is None:
+                self.load(user)
+                dependent_token = self._tokens.get(key)
+        if dependent_token is None:
+            self._exchanges.do(user.pk, self.exchange, user, bearer_token)
+            dependent_token = self._tokens.get(key)
+            if dependent_token is None:
+                return None
+        elif dependent_token.exp - self.refresh_ahead <= time.time():
+            self.refresh_in_background(user, bearer_token)
+        return dependent_token.access_token
+
+    def remember(self, user, dependent_token):
+        self._tokens.set((user.pk, dependent_token.resource_server), dependent_token,
+                         dependent_token.exp - self.min_lifetime)
+
+    def load(self, user):
+        """Load unexpired dependent tokens of the user stored in the database"""
+        for access_token in AccessToken.objects.filter(
+                user_association__user=user,
+                user_association__provider__iss="globus",
+                resource_server__isnull=False,
+                exp__gt=int(time.time()) + self.min_lifetime).order_by("exp"):
+            token = decrypt_token(access_token.access_token)
+            if token is None:
+                continue
+            self.remember(user, DependentToken(
+                    token, access_token.resource_server, access_token.scope, access_token.exp))
+
+    def exchange(self, user, bearer_token):
+        """Exchange the bearer token for dependent tokens and store them"""
+        # Never send a token of another provider to Globus
+        try:
+            user_association = UserAssociation.objects.get(user=user, provider__iss="globus")
+        except UserAssociation.DoesNotExist:
+            msg = "No Globus identity of the user"
+            raise exceptions.AuthenticationFailed(msg)
+        content = GlobusAuthentication().exchange_dependent_tokens(bearer_token)
+
+        unix_time = int(time.time())
+        token_writer = get_token_writer()
+        issued = set()
+        expires = unix_time + self.refresh_ahead
+        for item in content:
+            token = item.get("access_token")
+            resource_server = item.get("resource_server")
+            expires_in = item.get("expires_in")
+            if not token or not resource_server or not expires_in:
+                continue
+            dependent_token = DependentToken(token, resource_server, item.get("scope") or "",
+                                             unix_time + int(expires_in))
+            token_writer.put(AccessToken(
+                    user_association=user_association,
+                    access_token=encrypt_token(token),
+                    access_token_hash=token_digest(token),
+                    scope=dependent_token.scope,
+                    exp=dependent_token.exp,
+                    resource_server=resource_server))
+            self.remember(user, dependent_token)
+            issued.add(resource_server)
+            expires = max(expires, dependent_token.exp - self.min_lifetime)
+        self._issued.set(user.pk, frozenset(issued), expires)
+        logger.debug("{} dependent tokens of {} obtained".format(len(issued), user.username))
+
+    def refresh_in_background(self, user, bearer_token):
+        with self._lock:
+            if user.pk in self._refreshing:
+                return
+            self._refreshing.add(user.pk)
+        get_refresh_executor().submit(self.refresh, user, bearer_token)
+
+    def refresh(self, user, bearer_token):
+        try:
+            self._exchanges.do(user.pk, self.exchange, user, bearer_token)
+        except Exception as e:
+            logger.warning("Could not refresh dependent tokens of {}: {}".format(user.username, e))
+        finally:
+            with self._lock:
+                self._refreshing.discard(user.pk)
+            connections.close_all()
+
+
+_dependent_token_cache = None
+_dependent_token_cache_lock = threading.Lock()
+
+
+def get_dependent_token_cache():
+    """Return the process-wide dependent token cache
+
+    The cache is configured by the optional "DependentTokens" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "DependentTokens": {"max_size": 10000, "refresh_ahead": 300, "min_lifetime": 60}
+    """
+    global _dependent_token_cache
+    if _dependent_token_cache is None:
+        with _dependent_token_cache_lock:
+            if _dependent_token_cache is None:
+                conf = settings.MULTIPROVIDER_AUTH.get("DependentTokens", {})
+                _dependent_token_cache = DependentTokenCache(
+                        max_size=conf.get("max_size", DEFAULT_MAX_SIZE),
+                        refresh_ahead=conf.get("refresh_ahead", DEFAULT_REFRESH_AHEAD),
+                        min_lifetime=conf.get("min_lifetime", DEFAULT_MIN_LIFETIME))
+    return _dependent_token_cache
+
+
+def get_dependent_token(request, resource_server):
+    """Return a dependent access token for the resource server of the user
+    authenticated with a Globus token, or None if Globus did not issue one
+    or the request was not authenticated with a Globus token
+
+    Parameters
+    ----------
+    request : Request
+        request authenticated by GlobusAuthentication or MultiproviderAuthentication
+    resource_server : str
+        resource server of the dependent token, e.g. 'transfer.api.globus.org'
+    """
+    access_token = request.auth
+    if (not isinstance(access_token, AccessToken) or access_token.resource_server is not None
+            or access_token.user_association.provider.iss != "globus"):
+        logger.debug("No dependent tokens for a request not authenticated with a Globus token")
+        return None
+    bearer_token = MultiproviderBaseAuthentication().get_token(request)
+    return get_dependent_token_cache().get_token(request.user, bearer_token, resource_server)
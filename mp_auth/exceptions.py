@@ -0,0 +1,9 @@
+from rest_framework import exceptions
+
+
+class TransientAuthenticationFailed(exceptions.AuthenticationFailed):
+    """Authentication failed for a reason that may go away when the request
+    is retried, e.g. an Identity Provider could not be reached. Unlike other
+    failures, it is not remembered in the negative cache."""
+
+    default_detail = "Could not verify the token, try again later."
@@ -0,0 +1,474 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from cryptography.x509 import load_pem_x509_certificate
+from cryptography.hazmat.backends import default_backend
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.db import close_old_connections, connections
+from . import metrics
+from .exceptions import TransientAuthenticationFailed
+from .models import JsonWebKey, Provider
+from .session import get_async_http_client, get_http_client
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_AGE = 3600
+DEFAULT_MIN_REFRESH_INTERVAL = 60
+DEFAULT_REFRESH_INTERVAL = 300
+
+MAX_AGE_RE = re.compile(r"(?:^|,)\s*(?:s-)?max-age\s*=\s*\"?(\d+)\"?", re.IGNORECASE)
+
+
+def parse_max_age(cache_control, default):
+    """Return the lifetime (in seconds) of a response from its Cache-Control header"""
+    if not cache_control:
+        return default
+    directives = cache_control.lower()
+    if "no-store" in directives or "no-cache" in directives:
+        return 0
+    match = MAX_AGE_RE.search(cache_control)
+    if match:
+        return int(match.group(1))
+    return default
+
+
+def load_public_key(x5c):
+    """Return the public key of a base64 encoded DER certificate from a JWK x5c chain"""
+    cert_str = "-----BEGIN CERTIFICATE-----\n" + x5c + "\n-----END CERTIFICATE-----"
+    cert_obj = load_pem_x509_certificate(cert_str.encode(), default_backend())
+    return cert_obj.public_key()
+
+
+class KeySet:
+    """JSON Web Key Set of a single issuer
+
+    Along with the JWKs, the set keeps their public keys parsed from the
+    certificates, so that a certificate is parsed once per key rotation
+    and not for every verified token.
+    """
+
+    def __init__(self, iss):
+        self.iss = iss
+        self.keys = {}
+        self.public_keys = {}
+        self.expires = 0
+        self.last_fetch = 0
+        self.loaded = False
+        self.refreshing = False
+        self.last_error = None
+        self.pending = None
+        self.lock = threading.Lock()
+
+
+class JWKSCache:
+    """Per-issuer cache of JSON Web Key Sets
+
+    Keys are loaded from the database the first time an issuer is seen and
+    kept in memory afterwards. A key set that outlived the max-age of the
+    JWKS response is refreshed in the background, so verification of tokens
+    signed with known keys never waits for the Identity Provider. The JWKS
+    is downloaded synchronously only for a kid that has never been seen, and
+    no more often than once per min_refresh_interval seconds per issuer.
+
+    Parameters
+    ----------
+    max_age : int
+        lifetime of a key set if the JWKS response has no Cache-Control header
+    min_refresh_interval : int
+        minimum number of seconds between two downloads of the same JWKS
+    """
+
+    def __init__(self, max_age=DEFAULT_MAX_AGE, min_refresh_interval=DEFAULT_MIN_REFRESH_INTERVAL):
+        self.max_age = max_age
+        self.min_refresh_interval = min_refresh_interval
+        self._keysets = {}
+        self._jwks_uris = {}
+        self._lock = threading.Lock()
+
+    def get_keyset(self, iss):
+        keyset = self._keysets.get(iss)
+        if keyset is None:
+            with self._lock:
+                keyset = self._keysets.setdefault(iss, KeySet(iss))
+        return keyset
+
+    def get_key(self, provider, kid):
+        """Return a JWK with the given kid published by the provider or None
+
+        Raises TransientAuthenticationFailed for an unknown kid if the JWKS
+        was downloaded less than min_refresh_interval seconds ago, because
+        the key may have been published since then.
+
+        Parameters
+        ----------
+        provider : Provider
+            issuer of the key
+        kid : str
+            key id from the JWT header
+        """
+        keyset = self.get_keyset(provider.iss)
+        if not keyset.loaded:
+            self.load(keyset, provider)
+
+        key = keyset.keys.get(kid)
+        if key is not None:
+            if keyset.expires <= time.time():
+                self.refresh_in_background(keyset, provider)
+            return key
+
+        # Unknown kid, the issuer may have rotated its keys
+        if not self.refresh(keyset, provider):
+            return self.get_skipped_key(keyset, kid)
+        return keyset.keys.get(kid)
+
+    def get_public_key(self, provider, kid):
+        """Return the public key with the given kid published by the provider
+        and its algorithm, or (None, None) if there is no such key
+
+        Parameters
+        ----------
+        provider : Provider
+            issuer of the key
+        kid : str
+            key id from the JWT header
+        """
+        key = self.get_key(provider, kid)
+        if key is None:
+            return None, None
+        public_key = self.get_keyset(provider.iss).public_keys.get(kid)
+        if public_key is None:
+            return None, None
+        return public_key, key["alg"]
+
+    async def aget_key(self, provider, kid):
+        """Async counterpart of get_key"""
+        keyset = self.get_keyset(provider.iss)
+        if not keyset.loaded:
+            if provider.pk is None:
+                self.load(keyset, provider)
+            else:
+                await sync_to_async(self.load)(keyset, provider)
+
+        key = keyset.keys.get(kid)
+        if key is not None:
+            if keyset.expires <= time.time():
+                self.refresh_in_background(keyset, provider)
+            return key
+
+        if not await self.arefresh(keyset, provider):
+            return self.get_skipped_key(keyset, kid)
+        return keyset.keys.get(kid)
+
+    def get_skipped_key(self, keyset, kid):
+        """Return a JWK with the given kid or, if there is no such key,
+        raise TransientAuthenticationFailed, when the JWKS was not downloaded
+        because it was downloaded recently"""
+        key = keyset.keys.get(kid)
+        if key is None:
+            msg = "Could not obtain a corresponding JWK"
+            raise TransientAuthenticationFailed(msg)
+        return key
+
+    async def aget_public_key(self, provider, kid):
+        """Async counterpart of get_public_key"""
+        key = await self.aget_key(provider, kid)
+        if key is None:
+            return None, None
+        public_key = self.get_keyset(provider.iss).public_keys.get(kid)
+        if public_key is None:
+            return None, None
+        return public_key, key["alg"]
+
+    def set_keys(self, keyset, keys):
+        """Replace keys of the key set, parsing only certificates that changed"""
+        public_keys = {}
+        for kid, jwk in keys.items():
+            old = keyset.keys.get(kid)
+            if old is not None and old["x5c"] == jwk["x5c"] and kid in keyset.public_keys:
+                public_keys[kid] = keyset.public_keys[kid]
+                continue
+            try:
+                public_keys[kid] = load_public_key(jwk["x5c"])
+            except Exception as e:
+                logger.warning("Could not load JWK {} of {}: {}".format(kid, keyset.iss, e))
+        keyset.public_keys = public_keys
+        keyset.keys = keys
+
+    def load(self, keyset, provider):
+        """Load keys of the provider stored in the database. Keys of an unsaved
+        provider, e.g. a stateless JWT issuer, are kept in memory only."""
+        with keyset.lock:
+            if keyset.loaded:
+                return
+            if provider.pk is not None:
+                self.set_keys(keyset, {
+                    key.kid: {"kid": key.kid, "alg": key.alg, "kty": key.kty, "x5c": key.x5c}
+                    for key in JsonWebKey.objects.filter(iss=provider)
+                })
+            keyset.loaded = True
+
+    def refresh(self, keyset, provider):
+        """Download the JWKS of the provider unless it was downloaded recently
+
+        Returns
+        -------
+        fetched : bool
+            False if the download was skipped
+        """
+        with keyset.lock:
+            if time.time() - keyset.last_fetch < self.min_refresh_interval:
+                return False
+            keyset.last_fetch = time.time()
+            try:
+                with metrics.timed("jwks_fetch_seconds", "jwt", issuer=keyset.iss):
+                    keys, max_age = self.fetch(keyset.iss)
+            except Exception as e:
+                logger.warning("Could not download JWKS from {}: {}".format(keyset.iss, e))
+                keyset.last_error = e
+                metrics.increment("jwks_fetch", "jwt", issuer=keyset.iss, result="failure")
+                return True
+            metrics.increment("jwks_fetch", "jwt", issuer=keyset.iss, result="success")
+            keyset.last_error = None
+            keyset.expires = time.time() + max_age
+            if keys != keyset.keys:
+                if provider.pk is not None:
+                    self.store(provider, keys)
+                self.set_keys(keyset, keys)
+            return True
+
+    async def arefresh(self, keyset, provider):
+        """Async counterpart of refresh. Coroutines of the same event loop
+        wait for a download that is already in progress."""
+        loop = asyncio.get_running_loop()
+        pending = keyset.pending
+        if pending is not None and pending.get_loop() is loop:
+            await asyncio.shield(pending)
+            return True
+        if time.time() - keyset.last_fetch < self.min_refresh_interval:
+            return False
+        keyset.last_fetch = time.time()
+        keyset.pending = loop.create_future()
+        try:
+            try:
+                with metrics.timed("jwks_fetch_seconds", "jwt", issuer=keyset.iss):
+                    keys, max_age = await self.afetch(keyset.iss)
+            except Exception as e:
+                logger.warning("Could not download JWKS from {}: {}".format(keyset.iss, e))
+                keyset.last_error = e
+                metrics.increment("jwks_fetch", "jwt", issuer=keyset.iss, result="failure")
+                return True
+            metrics.increment("jwks_fetch", "jwt", issuer=keyset.iss, result="success")
+            keyset.last_error = None
+            keyset.expires = time.time() + max_age
+            if keys != keyset.keys:
+                if provider.pk is not None:
+                    await sync_to_async(self.store)(provider, keys)
+                self.set_keys(keyset, keys)
+            return True
+        finally:
+            keyset.pending.set_result(None)
+            keyset.pending = None
+
+    def refresh_in_background(self, keyset, provider):
+        if keyset.refreshing or time.time() - keyset.last_fetch < self.min_refresh_interval:
+            return
+        keyset.refreshing = True
+
+        def run():
+            try:
+                self.refresh(keyset, provider)
+            finally:
+                keyset.refreshing = False
+                connections.close_all()
+
+        threading.Thread(target=run, name="mp-auth-jwks-refresh", daemon=True).start()
+
+    def fetch(self, iss):
+        """Download the JWKS of the issuer
+
+        Returns
+        -------
+        keys : dict
+            JWKs by kid
+        max_age : int
+            number of seconds the keys can be cached for
+        """
+        jwks_uri = self._jwks_uris.get(iss)
+        if jwks_uri is None:
+            if self.uses_discovery(iss):
+                resp = get_http_client().get(iss + ".well-known/openid-configuration")
+                resp.raise_for_status()
+                jwks_uri = self.parse_configuration(iss, resp.json())
+            else:
+                jwks_uri = iss + ".well-known/jwks.json"
+            self._jwks_uris[iss] = jwks_uri
+        resp = get_http_client().get(jwks_uri)
+        resp.raise_for_status()
+        return self.parse(resp.json(), resp.headers.get("Cache-Control"))
+
+    async def afetch(self, iss):
+        """Async counterpart of fetch"""
+        jwks_uri = self._jwks_uris.get(iss)
+        if jwks_uri is None:
+            if self.uses_discovery(iss):
+                resp = await get_async_http_client().get(iss + ".well-known/openid-configuration")
+                resp.raise_for_status()
+                jwks_uri = self.parse_configuration(iss, resp.json())
+            else:
+                jwks_uri = iss + ".well-known/jwks.json"
+            self._jwks_uris[iss] = jwks_uri
+        resp = await get_async_http_client().get(jwks_uri)
+        resp.raise_for_status()
+        return self.parse(resp.json(), resp.headers.get("Cache-Control"))
+
+    def uses_discovery(self, iss):
+        """Return True if the JWKS location of the issuer is read from its
+        OpenID Connect discovery document, e.g.
+        "JWT": {"https://example.com/": {"aud": "...", "discovery": True}}
+        """
+        return bool(settings.MULTIPROVIDER_AUTH.get("JWT", {}).get(iss, {}).get("discovery"))
+
+    def parse_configuration(self, iss, configuration):
+        """Return the jwks_uri from an OpenID Connect discovery document"""
+        issuer = configuration.get("issuer")
+        if issuer and issuer.rstrip("/") != iss.rstrip("/"):
+            raise ValueError("Discovery document of {} is issued for {}".format(iss, issuer))
+        jwks_uri = configuration.get("jwks_uri")
+        if not jwks_uri:
+            raise ValueError("No jwks_uri in the discovery document of {}".format(iss))
+        return jwks_uri
+
+    def parse(self, jwks, cache_control):
+        """Return JWKs by kid from a JWKS document and the number of
+        seconds they can be cached for"""
+        keys = {}
+        for jwk in jwks.get("keys"):
+            kid = jwk.get("kid")
+            x5c = jwk.get("x5c")
+            if not kid or not x5c:
+                continue
+            keys[kid] = {"kid": kid, "alg": jwk.get("alg"), "kty": jwk.get("kty"), "x5c": x5c[0]}
+        return keys, parse_max_age(cache_control, self.max_age)
+
+    def store(self, provider, keys):
+        """Write changed keys of the provider to the database"""
+        stored = {key.kid: key for key in JsonWebKey.objects.filter(iss=provider)}
+        for kid, jwk in keys.items():
+            key = stored.get(kid)
+            if key and (key.alg, key.kty, key.x5c) == (jwk["alg"], jwk["kty"], jwk["x5c"]):
+                continue
+            JsonWebKey.objects.update_or_create(
+                kid=kid,
+                defaults={"iss": provider, "alg": jwk["alg"], "kty": jwk["kty"], "x5c": jwk["x5c"]}
+            )
+            logger.debug("JWK {} of {} updated".format(kid, provider.iss))
+        removed = set(stored) - set(keys)
+        if removed:
+            JsonWebKey.objects.filter(iss=provider, kid__in=removed).delete()
+            logger.debug("JWKs {} of {} removed".format(", ".join(removed), provider.iss))
+
+
+_jwks_cache = None
+_jwks_cache_lock = threading.Lock()
+
+
+def get_jwks_cache():
+    """Return the process-wide JWKS cache
+
+    The cache is configured by the optional "JWKS" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "JWKS": {"max_age": 3600, "min_refresh_interval": 60}
+    """
+    global _jwks_cache
+    if _jwks_cache is None:
+        with _jwks_cache_lock:
+            if _jwks_cache is None:
+                conf = settings.MULTIPROVIDER_AUTH.get("JWKS", {})
+                _jwks_cache = JWKSCache(
+                        max_age=conf.get("max_age", DEFAULT_MAX_AGE),
+                        min_refresh_interval=conf.get("min_refresh_interval", DEFAULT_MIN_REFRESH_INTERVAL))
+    return _jwks_cache
+
+
+class JWKSRefresher:
+    """Background thread that prefetches key sets of all JWT issuers when the
+    application starts and keeps them current afterwards
+
+    Every refresh_interval seconds, key sets that would expire before the next
+    check are downloaded again, so that keys published ahead of a rotation are
+    known before the first token signed with them arrives. Unreachable issuers
+    are logged and retried on the next check.
+
+    Parameters
+    ----------
+    issuers : list
+        issuers of JWTs
+    refresh_interval : int
+        number of seconds between checks, 0 to prefetch the keys only
+    """
+
+    def __init__(self, issuers, refresh_interval=DEFAULT_REFRESH_INTERVAL):
+        self.issuers = issuers
+        self.refresh_interval = refresh_interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="mp-auth-jwks-refresher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        # Do not touch the database before all applications are ready
+        apps.ready_event.wait()
+        jwks_cache = get_jwks_cache()
+        jwt_idps = settings.MULTIPROVIDER_AUTH.get("JWT") or {}
+        providers = {}
+        while True:
+            close_old_connections()
+            for iss in self.issuers:
+                try:
+                    provider = providers.get(iss)
+                    if provider is None:
+                        # Keys of stateless issuers are kept in memory only
+                        if (jwt_idps.get(iss) or {}).get("stateless"):
+                            provider = Provider(iss=iss)
+                        else:
+                            provider, _created = Provider.objects.get_or_create(iss=iss)
+                        providers[iss] = provider
+                    keyset = jwks_cache.get_keyset(iss)
+                    if not keyset.loaded:
+                        jwks_cache.load(keyset, provider)
+                    if keyset.expires <= time.time() + self.refresh_interval:
+                        jwks_cache.refresh(keyset, provider)
+                except Exception as e:
+                    logger.warning("Could not refresh JWKS of {}: {}".format(iss, e))
+            if not self.refresh_interval or self._stop.wait(self.refresh_interval):
+                break
+        connections.close_all()
+
+
+_jwks_refresher = None
+
+
+def start_jwks_refresher():
+    """Start the background JWKS refresher if it is enabled by the optional
+    "JWKS" section of MULTIPROVIDER_AUTH in settings.py, e.g.
+    "JWKS": {"prefetch": True, "refresh_interval": 300}
+    """
+    global _jwks_refresher
+    conf = settings.MULTIPROVIDER_AUTH.get("JWKS", {})
+    issuers = list(settings.MULTIPROVIDER_AUTH.get("JWT", {}))
+    if not conf.get("prefetch") or not issuers or _jwks_refresher is not None:
+        return _jwks_refresher
+    _jwks_refresher = JWKSRefresher(
+            issuers, refresh_interval=conf.get("refresh_interval", DEFAULT_REFRESH_INTERVAL))
+    _jwks_refresher.start()
+    return _jwks_refresher
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from mp_auth.pruner import DEFAULT_BATCH_SIZE, purge_expired_tokens
+
+
+class Command(BaseCommand):
+    help = "Delete expired access tokens and their audiences"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+            help="Maximum number of access tokens deleted at once (default: {})".format(DEFAULT_BATCH_SIZE))
+
+    def handle(self, *args, **options):
+        tokens, audiences, elapsed = purge_expired_tokens(options["batch_size"])
+        self.stdout.write("Deleted {} access tokens and {} audiences in {:.3f}s".format(tokens, audiences, elapsed))
@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+# Events reported to collectors, with their descriptions
+COUNTERS = {
+    "cache_hit": "Access tokens found in a cache (tier: memory, shared or database)",
+    "cache_miss": "Access tokens not found in any cache",
+    "negative_cache_hit": "Access tokens rejected by the negative cache",
+    "introspection": "Introspections of access tokens (result: success, failure or transient)",
+    "jwks_fetch": "Downloads of JSON Web Key Sets (result: success or failure)",
+    "user_provisioned": "Users created for new provider identities",
+    "failure": "Rejected access tokens by reason",
+}
+HISTOGRAMS = {
+    "cache_lookup_seconds": "Duration of access token lookups in the database",
+    "introspection_seconds": "Duration of introspections of access tokens",
+    "jwks_fetch_seconds": "Duration of downloads of JSON Web Key Sets",
+    "verification_seconds": "Duration of JWT signature verifications",
+    "provisioning_seconds": "Duration of user lookups and provisioning",
+}
+
+
+class Collector:
+    """Base class of metrics collectors
+
+    Collectors are configured by the optional "Metrics" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "Metrics": {"collectors": ["mp_auth.metrics.PrometheusCollector"]}
+    or added with add_collector(). Without collectors, instrumentation of
+    the authentication classes costs a single check of an empty list.
+
+    Every event is labeled with the name of the authentication class that
+    reported it ("multiprovider" for MultiproviderAuthentication). Events
+    of a specific issuer, e.g. JWKS downloads, are also labeled with the
+    issuer.
+    """
+
+    def increment(self, name, backend, labels):
+        """Count an event
+
+        Parameters
+        ----------
+        name : str
+            event, one of COUNTERS
+        backend : str
+            name of the authentication class
+        labels : dict
+            additional labels of the event
+        """
+
+    def observe(self, name, backend, seconds, labels):
+        """Record a duration
+
+        Parameters
+        ----------
+        name : str
+            measured operation, one of HISTOGRAMS
+        backend : str
+            name of the authentication class
+        seconds : float
+            duration of the operation
+        labels : dict
+            additional labels of the operation
+        """
+
+
+# Failure reasons with a bounded set of values, others are reported as "other"
+FAILURE_REASONS = {
+    "Token not active",
+    "Token expired",
+    "Wrong audience of the token",
+    "Wrong scope of the token",
+    "Invalid introspection response",
+    "Error when decoding the JWT token",
+    "Unsupported JWT token type",
+    "Unsupported JWT token algorithm",
+    "Prohibited JWT token issuer",
+    "Invalid audience",
+    "No sub claim in the JWT token",
+    "Could not obtain a corresponding JWK",
+    "Could not introspect the token",
+    "Could not create a user",
+    "No provider can authenticate the token",
+    "transient",
+}
+
+
+class PrometheusCollector(Collector):
+    """Collector exporting counters and latency histograms with prometheus_client
+
+    Parameters
+    ----------
+    registry : prometheus_client.CollectorRegistry
+        registry of the metrics, the default registry if None
+    namespace : str
+        prefix of metric names
+    """
+
+    def __init__(self, registry=None, namespace="mp_auth"):
+        try:
+            import prometheus_client
+        except ImportError:
+            raise ImproperlyConfigured("PrometheusCollector requires prometheus_client")
+        self.prometheus_client = prometheus_client
+        self.registry = registry or prometheus_client.REGISTRY
+        self.namespace = namespace
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def get_metric(self, metric_class, name, description, label_names):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = self._metrics[name] = metric_class(
+                            name, description, ["backend"] + label_names,
+                            namespace=self.namespace, registry=self.registry)
+        return metric
+
+    def increment(self, name, backend, labels):
+        if name == "failure" and labels.get("reason") not in FAILURE_REASONS:
+            labels = dict(labels, reason="other")
+        label_names = sorted(labels)
+        counter = self.get_metric(self.prometheus_client.Counter, name, COUNTERS.get(name, name), label_names)
+        counter.labels(backend, *[labels[label] for label in label_names]).inc()
+
+    def observe(self, name, backend, seconds, labels):
+        label_names = sorted(labels)
+        histogram = self.get_metric(
+                self.prometheus_client.Histogram, name, HISTOGRAMS.get(name, name), label_names)
+        histogram.labels(backend, *[labels[label] for label in label_names]).observe(seconds)
+
+
+_collectors = None
+_collectors_lock = threading.Lock()
+
+
+def get_collectors():
+    """Return the configured metrics collectors"""
+    global _collectors
+    if _collectors is None:
+        with _collectors_lock:
+            if _collectors is None:
+                conf = settings.MULTIPROVIDER_AUTH.get("Metrics", {})
+                _collectors = [import_string(path)() for path in conf.get("collectors", [])]
+    return _collectors
+
+
+def add_collector(collector):
+    """Report metrics to an additional collector"""
+    get_collectors().append(collector)
+
+
+def increment(name, backend, **labels):
+    collectors = _collectors if _collectors is not None else get_collectors()
+    if not collectors:
+        return
+    for collector in collectors:
+        try:
+            collector.increment(name, backend or "multiprovider", labels)
+        except Exception as e:
+            logger.warning("Metrics collector {} failed: {}".format(collector, e))
+
+
+def observe(name, backend, seconds, **labels):
+    collectors = _collectors if _collectors is not None else get_collectors()
+    if not collectors:
+        return
+    for collector in collectors:
+        try:
+            collector.observe(name, backend or "multiprovider", seconds, labels)
+        except Exception as e:
+            logger.warning("Metrics collector {} failed: {}".format(collector, e))
+
+
+class Timer:
+    """Context manager recording the duration of its block"""
+
+    __slots__ = ("name", "backend", "labels", "start")
+
+    def __init__(self, name, backend, labels):
+        self.name = name
+        self.backend = backend
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.name, self.backend, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class NullTimer:
+    """Timer used when no collectors are configured"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+def timed(name, backend, **labels):
+    """Return a context manager recording the duration of its block"""
+    collectors = _collectors if _collectors is not None else get_collectors()
+    if not collectors:
+        return NULL_TIMER
+    return Timer(name, backend, labels)
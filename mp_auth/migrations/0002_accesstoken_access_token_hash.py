@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-17 22:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mp_auth', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='access_token_hash',
+            field=models.CharField(max_length=64, null=True),
+        ),
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='access_token',
+            field=models.CharField(blank=True, max_length=8192, null=True),
+        ),
+    ]
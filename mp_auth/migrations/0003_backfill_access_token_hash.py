@@ -0,0 +1,67 @@
+from django.db import migrations, transaction
+
+from mp_auth.utils import token_digest
+
+BATCH_SIZE = 1000
+
+
+def legacy_token(value):
+    """Access tokens used to be stored as str() of the bearer token bytes,
+    i.e. "b'<token>'". Strip the bytes literal to recover the token."""
+    if value.startswith("b'") and value.endswith("'"):
+        return value[2:-1]
+    return value
+
+
+def backfill_access_token_hash(apps, schema_editor):
+    """Replace raw access tokens with their digests in batches, each batch
+    in its own transaction"""
+    AccessToken = apps.get_model("mp_auth", "AccessToken")
+    last_pk = 0
+    while True:
+        with transaction.atomic():
+            batch = list(
+                AccessToken.objects
+                .filter(pk__gt=last_pk, access_token_hash__isnull=True)
+                .order_by("pk")
+                .only("pk", "access_token", "exp")[:BATCH_SIZE])
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+
+            digests = {}
+            for access_token in batch:
+                digests[access_token.pk] = token_digest(legacy_token(access_token.access_token or ""))
+            # The same token could have been stored more than once, keep
+            # only the first record for every digest
+            seen = set(AccessToken.objects.filter(
+                    access_token_hash__in=set(digests.values())).values_list("access_token_hash", flat=True))
+            duplicates = set()
+            for access_token in batch:
+                digest = digests[access_token.pk]
+                if digest in seen:
+                    duplicates.add(access_token.pk)
+                    continue
+                seen.add(digest)
+                access_token.access_token_hash = digest
+                access_token.access_token = None
+
+            AccessToken.objects.filter(pk__in=duplicates).delete()
+            AccessToken.objects.bulk_update(
+                [t for t in batch if t.pk not in duplicates],
+                ["access_token_hash", "access_token"])
+
+
+class Migration(migrations.Migration):
+
+    # Batches are committed one by one, so that locks are not held until
+    # the whole table is backfilled
+    atomic = False
+
+    dependencies = [
+        ('mp_auth', '0002_accesstoken_access_token_hash'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_access_token_hash, migrations.RunPython.noop),
+    ]
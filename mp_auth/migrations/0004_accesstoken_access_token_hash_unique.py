@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mp_auth', '0003_backfill_access_token_hash'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='access_token_hash',
+            field=models.CharField(max_length=64, unique=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mp_auth', '0004_accesstoken_access_token_hash_unique'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='accesstoken',
+            name='exp',
+            field=models.IntegerField(db_index=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mp_auth', '0005_accesstoken_exp_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='accesstoken',
+            index=models.Index(fields=['access_token_hash', 'exp'], name='mp_auth_token_hash_exp_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-17 23:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mp_auth', '0006_accesstoken_hash_exp_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='accesstoken',
+            name='resource_server',
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='accesstoken',
+            index=models.Index(fields=['user_association', 'resource_server'], name='mp_auth_token_dependent_idx'),
+        ),
+    ]
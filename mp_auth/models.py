@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 from django.db import models
 from django.contrib.auth.models import User
+from .utils import get_audience_set, get_scope_set
 
 
 class Provider(models.Model):
@@ -25,9 +26,45 @@ class UserAssociation(models.Model):
 
 class AccessToken(models.Model):
     user_association = models.ForeignKey(UserAssociation, on_delete=models.CASCADE)
-    access_token = models.CharField(max_length=8192)
+    access_token = models.CharField(max_length=8192, null=True, blank=True)
+    access_token_hash = models.CharField(max_length=64, unique=True)
     scope = models.CharField(max_length=1024)
-    exp = models.IntegerField()
+    exp = models.IntegerField(db_index=True)
+    # Set for dependent tokens issued to the user for a downstream resource server
+    resource_server = models.CharField(max_length=1024, null=True, blank=True)
+    # Unix time the token was last introspected
+    validated_at = models.IntegerField(null=True, blank=True)
+
+    @property
+    def scopes(self):
+        """Frozenset of scopes of the token"""
+        try:
+            return self._scopes
+        except AttributeError:
+            self._scopes = get_scope_set(self.scope)
+            return self._scopes
+
+    @property
+    def audiences(self):
+        """Frozenset of audiences of the token, read from the database once
+        for a token loaded from the database"""
+        try:
+            return self._audiences
+        except AttributeError:
+            if self.pk is None:
+                return get_audience_set(())
+            self._audiences = get_audience_set(
+                    self.accesstokenaudience_set.values_list("aud", flat=True))
+            return self._audiences
+
+    def set_audiences(self, aud):
+        self._audiences = get_audience_set(aud)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["access_token_hash", "exp"], name="mp_auth_token_hash_exp_idx"),
+            models.Index(fields=["user_association", "resource_server"], name="mp_auth_token_dependent_idx"),
+        ]
 
 
 class AccessTokenAudience(models.Model):
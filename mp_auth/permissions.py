@@ -0,0 +1,40 @@
+from rest_framework.permissions import BasePermission
+from .utils import get_audience_set, get_scope_set
+
+
+class HasTokenScopes(BasePermission):
+    """Allow requests whose access token has all scopes in the view's
+    required_scopes and, if the view sets required_audiences, at least one
+    of these audiences, e.g.
+
+        class MyAPIView(APIView):
+            authentication_classes = (MultiproviderAuthentication,)
+            permission_classes = (HasTokenScopes,)
+            required_scopes = ("urn:globus:auth:scope:example.org:all",)
+            required_audiences = ("example.org",)
+
+    Scopes and audiences are kept with the validated token, so a request
+    authenticated from the cache is authorized without contacting the
+    Identity Provider.
+    """
+
+    message = "The access token does not have the required scopes or audiences."
+
+    def has_permission(self, request, view):
+        required_scopes = get_scope_set(getattr(view, "required_scopes", None))
+        required_audiences = get_audience_set(getattr(view, "required_audiences", None))
+        if not required_scopes and not required_audiences:
+            return True
+
+        # Tokens of stateless issuers are represented by the principal
+        token = request.auth if request.auth is not None else request.user
+        scopes = getattr(token, "scopes", None)
+        audiences = getattr(token, "audiences", None)
+        if scopes is None or audiences is None:
+            return False
+
+        if not required_scopes <= scopes:
+            return False
+        if required_audiences and required_audiences.isdisjoint(audiences):
+            return False
+        return True
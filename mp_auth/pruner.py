@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections
+from .models import AccessToken, AccessTokenAudience
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_INTERVAL = 3600
+
+
+def purge_expired_tokens(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """Delete expired access tokens and their audiences in batches, so
+    that the deletes do not lock the tables for long
+
+    Parameters
+    ----------
+    batch_size : int
+        maximum number of access tokens deleted at once
+    now : int
+        Unix time tokens that expired before are deleted, the current time by default
+
+    Returns
+    -------
+    tokens : int
+        number of deleted access tokens
+    audiences : int
+        number of deleted access token audiences
+    elapsed : float
+        duration of the purge in seconds
+    """
+    start = time.monotonic()
+    if now is None:
+        now = int(time.time())
+    tokens = 0
+    audiences = 0
+    while True:
+        pks = list(AccessToken.objects.filter(exp__lt=now).values_list("pk", flat=True)[:batch_size])
+        if not pks:
+            break
+        deleted, _rows = AccessTokenAudience.objects.filter(access_token_id__in=pks).delete()
+        audiences += deleted
+        deleted, _rows = AccessToken.objects.filter(pk__in=pks).delete()
+        tokens += deleted
+    elapsed = time.monotonic() - start
+    logger.info("Deleted {} expired access tokens and {} audiences in {:.3f}s".format(tokens, audiences, elapsed))
+    return tokens, audiences, elapsed
+
+
+class TokenPruner:
+    """Background thread that periodically purges expired access tokens
+
+    Parameters
+    ----------
+    interval : int
+        number of seconds between purges
+    batch_size : int
+        maximum number of access tokens deleted at once
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, batch_size=DEFAULT_BATCH_SIZE):
+        self.interval = interval
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="mp-auth-token-pruner", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            close_old_connections()
+            try:
+                purge_expired_tokens(self.batch_size)
+            except Exception as e:
+                logger.warning("Could not purge expired access tokens: {}".format(e))
+
+
+_token_pruner = None
+
+
+def start_token_pruner():
+    """Start the background pruner if it is enabled by the optional "Pruner"
+    section of MULTIPROVIDER_AUTH in settings.py, e.g.
+    "Pruner": {"enabled": True, "interval": 3600, "batch_size": 1000}
+    """
+    global _token_pruner
+    conf = settings.MULTIPROVIDER_AUTH.get("Pruner", {})
+    if not conf.get("enabled") or _token_pruner is not None:
+        return _token_pruner
+    _token_pruner = TokenPruner(
+            interval=conf.get("interval", DEFAULT_INTERVAL),
+            batch_size=conf.get("batch_size", DEFAULT_BATCH_SIZE))
+    _token_pruner.start()
+    return _token_pruner
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import weakref
+import requests
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_RETRIES = 2
+DEFAULT_BACKOFF_FACTOR = 0.5
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HTTPClient:
+    """HTTP client shared by all backends to call Identity Providers
+
+    Connections are kept alive in per-host pools (urllib3 pools are
+    thread-safe), every request has connect and read timeouts, and failed
+    connections or retryable responses are retried with exponential backoff.
+
+    Parameters
+    ----------
+    pool_connections : int
+        number of hosts connection pools are kept for
+    pool_maxsize : int
+        maximum number of connections kept alive per host
+    connect_timeout : float
+        timeout (in seconds) of establishing a connection
+    read_timeout : float
+        timeout (in seconds) of waiting for a response
+    retries : int
+        maximum number of retries of a request
+    backoff_factor : float
+        backoff factor of retries, see urllib3.util.retry.Retry
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+        self.timeout = (connect_timeout, read_timeout)
+        retry = Retry(
+                total=retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset(["GET", "POST"]),
+                raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+class AsyncHTTPClient:
+    """Non-blocking counterpart of HTTPClient for the async authentication path
+
+    Requires httpx. Takes the same parameters as HTTPClient; a client is
+    bound to the event loop it was created in.
+    """
+
+    def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 retries=DEFAULT_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR):
+        try:
+            import httpx
+        except ImportError:
+            raise ImproperlyConfigured("The async authentication path requires httpx")
+        self.httpx = httpx
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                        max_connections=pool_connections * pool_maxsize,
+                        max_keepalive_connections=pool_maxsize),
+                timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+
+    async def request(self, method, url, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                resp = await self.client.request(method, url, **kwargs)
+                if resp.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    return resp
+            except self.httpx.TransportError:
+                if attempt >= self.retries:
+                    raise
+            await asyncio.sleep(self.backoff_factor * (2 ** attempt))
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+
+def get_http_settings():
+    """Return HTTP client parameters from the optional "HTTP" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "HTTP": {"pool_maxsize": 10, "connect_timeout": 5, "read_timeout": 10,
+             "retries": 2, "backoff_factor": 0.5}
+    """
+    conf = settings.MULTIPROVIDER_AUTH.get("HTTP", {})
+    return {
+        "pool_connections": conf.get("pool_connections", DEFAULT_POOL_CONNECTIONS),
+        "pool_maxsize": conf.get("pool_maxsize", DEFAULT_POOL_MAXSIZE),
+        "connect_timeout": conf.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT),
+        "read_timeout": conf.get("read_timeout", DEFAULT_READ_TIMEOUT),
+        "retries": conf.get("retries", DEFAULT_RETRIES),
+        "backoff_factor": conf.get("backoff_factor", DEFAULT_BACKOFF_FACTOR),
+    }
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+_async_http_clients = weakref.WeakKeyDictionary()
+
+
+def get_http_client():
+    """Return the process-wide HTTP client"""
+    global _http_client
+    if _http_client is None:
+        with _http_client_lock:
+            if _http_client is None:
+                _http_client = HTTPClient(**get_http_settings())
+    return _http_client
+
+
+def get_async_http_client():
+    """Return the async HTTP client of the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _async_http_clients.get(loop)
+    if client is None:
+        client = _async_http_clients[loop] = AsyncHTTPClient(**get_http_settings())
+    return client
@@ -0,0 +1,79 @@
+import asyncio
+import threading
+
+
+class Call:
+    """A call in flight and its outcome"""
+
+    __slots__ = ("event", "result", "exception")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception = None
+
+
+class SingleFlight:
+    """Coalesce concurrent calls with the same key
+
+    The first caller of do() for a key runs the function, any caller that
+    comes while the function is running waits for it and gets the same
+    result or exception.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = Call()
+
+        if not leader:
+            call.event.wait()
+            if call.exception is not None:
+                raise call.exception
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.exception = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class AsyncSingleFlight:
+    """Coalesce concurrent coroutines with the same key
+
+    Async counterpart of SingleFlight, calls are coalesced within an
+    event loop. The function runs in its own task that every caller awaits
+    through asyncio.shield, so a cancelled caller, e.g. of a client that
+    disconnected, does not cancel the call for the others.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call_key = (loop, key)
+        task = self._calls.get(call_key)
+        if task is None:
+            task = self._calls[call_key] = loop.create_task(fn(*args, **kwargs))
+
+            def done(task):
+                del self._calls[call_key]
+                # Mark the exception as retrieved if all callers were cancelled
+                if not task.cancelled():
+                    task.exception()
+
+            task.add_done_callback(done)
+        return await asyncio.shield(task)
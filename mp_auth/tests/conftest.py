@@ -0,0 +1,14 @@
+import os
+import django
+
+
+def pytest_configure(config):
+    """Set up Django and the test database when the tests are run by pytest
+    without pytest-django"""
+    if config.pluginmanager.hasplugin("django"):
+        return
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mp_auth.tests.settings")
+    django.setup()
+    from django.test.utils import setup_databases, setup_test_environment
+    setup_test_environment()
+    setup_databases(verbosity=0, interactive=False)
@@ -0,0 +1,43 @@
+"""Minimal settings of the test suite, e.g.
+
+    DJANGO_SETTINGS_MODULE=mp_auth.tests.settings python -m django test mp_auth.tests
+"""
+
+SECRET_KEY = "mp-auth-tests"
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "rest_framework",
+    "mp_auth",
+]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    }
+}
+
+USE_TZ = True
+
+DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
+
+JWT_ISSUER = "https://issuer.example.org/"
+STATELESS_JWT_ISSUER = "https://stateless.example.org/"
+AUDIENCE = "mp-auth-tests"
+
+MULTIPROVIDER_AUTH = {
+    "JWT": {
+        JWT_ISSUER: {"aud": AUDIENCE},
+        STATELESS_JWT_ISSUER: {"aud": AUDIENCE, "stateless": True},
+    },
+    "BearerTokens": {
+        "globus": {"aud": AUDIENCE, "scope": []},
+    },
+    # Tokens are written by the authenticating thread, inside the test transaction
+    "WriteBehind": {"enabled": False},
+}
+
+GLOBUS_CLIENT_ID = "mp-auth-tests"
+GLOBUS_CLIENT_SECRET = "mp-auth-tests"
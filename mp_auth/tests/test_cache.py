@@ -0,0 +1,143 @@
+import base64
+import datetime
+import pickle
+import time
+import uuid
+from types import SimpleNamespace
+import jwt
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import RequestFactory, TestCase
+from mp_auth.backends.globus import GlobusAuthentication
+from mp_auth.backends.jwt import JWTAuthentication, JWTPrincipal
+from mp_auth.backends.mp import MultiproviderAuthentication
+from mp_auth.cache import get_negative_cache, get_token_cache
+from mp_auth.jwks import get_jwks_cache
+from mp_auth.models import AccessToken, AccessTokenAudience, Provider, UserAssociation
+from mp_auth.permissions import HasTokenScopes
+from mp_auth.utils import token_digest
+
+
+def generate_key():
+    """Return a private RSA key and a JWK with a self-signed certificate of
+    its public key"""
+    kid = uuid.uuid4().hex
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, kid)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (x509.CertificateBuilder()
+            .subject_name(name).issuer_name(name)
+            .public_key(private_key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=1))
+            .sign(private_key, hashes.SHA256()))
+    x5c = base64.b64encode(cert.public_bytes(serialization.Encoding.DER)).decode()
+    return private_key, {"kid": kid, "alg": "RS256", "kty": "RSA", "x5c": x5c}
+
+
+def jwt_token(private_key, jwk, iss, sub="tester"):
+    claims = {"iss": iss, "sub": sub, "aud": settings.AUDIENCE, "exp": int(time.time()) + 3600,
+              "jti": uuid.uuid4().hex}
+    token = jwt.encode(claims, private_key, algorithm="RS256", headers={"kid": jwk["kid"], "typ": "JWT"})
+    return token.decode() if isinstance(token, bytes) else token
+
+
+class CacheQueriesTestCase(TestCase):
+    """Number of database queries of authentication by each cache tier"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.private_key, cls.jwk = generate_key()
+        # Keys of the stateless issuer are never fetched nor stored
+        jwks_cache = get_jwks_cache()
+        keyset = jwks_cache.get_keyset(settings.STATELESS_JWT_ISSUER)
+        jwks_cache.set_keys(keyset, {cls.jwk["kid"]: cls.jwk})
+        keyset.loaded = True
+        keyset.expires = time.time() + 3600
+
+    def setUp(self):
+        get_token_cache().clear()
+        get_negative_cache().clear()
+        self.factory = RequestFactory()
+
+    def request(self, token):
+        return self.factory.get("/", HTTP_AUTHORIZATION="Bearer " + token)
+
+    def store_token(self, iss, uid, audiences=()):
+        """Store a new access token of the issuer in the database"""
+        token = uuid.uuid4().hex if iss == "globus" else jwt_token(self.private_key, self.jwk, iss, uid)
+        provider, _created = Provider.objects.get_or_create(iss=iss)
+        user = get_user_model().objects.create(username=uid)
+        user_association = UserAssociation.objects.create(user=user, uid=uid, provider=provider)
+        access_token = AccessToken.objects.create(
+                user_association=user_association, access_token_hash=token_digest(token),
+                scope="", exp=int(time.time()) + 3600)
+        for aud in audiences:
+            AccessTokenAudience.objects.create(access_token=access_token, aud=aud)
+        return token, access_token
+
+    def assertDatabaseHit(self, authentication, token, access_token):
+        authentication.authenticate(self.request(token))
+        get_token_cache().clear()
+        with self.assertNumQueries(1):
+            user, auth = authentication.authenticate(self.request(token))
+        self.assertEqual(auth.pk, access_token.pk)
+        self.assertEqual(user.pk, access_token.user_association.user_id)
+
+    def assertMemoryHit(self, authentication, token, access_token):
+        authentication.authenticate(self.request(token))
+        with self.assertNumQueries(0):
+            user, auth = authentication.authenticate(self.request(token))
+        self.assertEqual(auth.pk, access_token.pk)
+
+    def assertStateless(self, authentication):
+        token = jwt_token(self.private_key, self.jwk, settings.STATELESS_JWT_ISSUER)
+        with self.assertNumQueries(0):
+            principal, auth = authentication.authenticate(self.request(token))
+            principal, auth = authentication.authenticate(self.request(token))
+        self.assertIsInstance(principal, JWTPrincipal)
+        self.assertIsNone(auth)
+
+    def test_jwt_database_hit(self):
+        self.assertDatabaseHit(JWTAuthentication(), *self.store_token(settings.JWT_ISSUER, "jwt-user"))
+
+    def test_jwt_memory_hit(self):
+        self.assertMemoryHit(JWTAuthentication(), *self.store_token(settings.JWT_ISSUER, "jwt-user"))
+
+    def test_jwt_stateless(self):
+        self.assertStateless(JWTAuthentication())
+
+    def test_globus_database_hit(self):
+        self.assertDatabaseHit(GlobusAuthentication(), *self.store_token("globus", "globus-user"))
+
+    def test_globus_memory_hit(self):
+        self.assertMemoryHit(GlobusAuthentication(), *self.store_token("globus", "globus-user"))
+
+    def test_multiprovider_database_hit(self):
+        self.assertDatabaseHit(MultiproviderAuthentication(), *self.store_token(settings.JWT_ISSUER, "jwt-user"))
+        self.assertDatabaseHit(MultiproviderAuthentication(), *self.store_token("globus", "globus-user"))
+
+    def test_multiprovider_memory_hit(self):
+        self.assertMemoryHit(MultiproviderAuthentication(), *self.store_token(settings.JWT_ISSUER, "jwt-user"))
+        self.assertMemoryHit(MultiproviderAuthentication(), *self.store_token("globus", "globus-user"))
+
+    def test_multiprovider_stateless(self):
+        self.assertStateless(MultiproviderAuthentication())
+
+    def test_database_hit_authorization(self):
+        token, access_token = self.store_token("globus", "globus-user", audiences=[settings.AUDIENCE, "other"])
+        view = SimpleNamespace(required_audiences=(settings.AUDIENCE,))
+        with self.assertNumQueries(1):
+            user, auth = MultiproviderAuthentication().authenticate(self.request(token))
+            self.assertTrue(HasTokenScopes().has_permission(SimpleNamespace(user=user, auth=auth), view))
+        self.assertEqual(auth.pk, access_token.pk)
+
+        # The token as another worker reads it from the shared cache
+        auth = pickle.loads(pickle.dumps(auth))
+        with self.assertNumQueries(0):
+            self.assertTrue(HasTokenScopes().has_permission(SimpleNamespace(user=user, auth=auth), view))
@@ -0,0 +1,33 @@
+import time
+from django.conf import settings
+from django.test import RequestFactory, TestCase
+from mp_auth.backends.jwt import JWTAuthentication
+from mp_auth.cache import get_negative_cache, get_token_cache
+from mp_auth.exceptions import TransientAuthenticationFailed
+from mp_auth.jwks import get_jwks_cache
+from mp_auth.utils import token_digest
+from .test_cache import generate_key, jwt_token
+
+
+class KeyRotationTestCase(TestCase):
+    """Tokens signed with a key that is not in the cached JWKS"""
+
+    def setUp(self):
+        get_token_cache().clear()
+        get_negative_cache().clear()
+        self.keyset = get_jwks_cache().get_keyset(settings.STATELESS_JWT_ISSUER)
+        self.last_fetch = self.keyset.last_fetch
+
+    def tearDown(self):
+        self.keyset.last_fetch = self.last_fetch
+
+    def test_unknown_kid_after_recent_fetch(self):
+        # The JWKS was just downloaded, so it is not downloaded again
+        self.keyset.loaded = True
+        self.keyset.last_fetch = time.time()
+        private_key, jwk = generate_key()
+        token = jwt_token(private_key, jwk, settings.STATELESS_JWT_ISSUER)
+        request = RequestFactory().get("/", HTTP_AUTHORIZATION="Bearer " + token)
+        with self.assertRaises(TransientAuthenticationFailed):
+            JWTAuthentication().authenticate(request)
+        self.assertIsNone(get_negative_cache().get((JWTAuthentication.name, token_digest(token))))
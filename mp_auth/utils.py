@@ -0,0 +1,80 @@
+import base64
+import hashlib
+import json
+import sys
+
+# Identical sets of scopes or audiences of different tokens share one instance
+MAX_INTERNED_SETS = 4096
+_interned_sets = {}
+
+
+def token_digest(access_token):
+    """Return the hex SHA-256 digest of an access token
+
+    Parameters
+    ----------
+    access_token : str|bytes
+        access token as extracted from the HTTP Authorization header
+    """
+    if isinstance(access_token, str):
+        access_token = access_token.encode()
+    return hashlib.sha256(access_token).hexdigest()
+
+
+def decode_jwt_segment(segment):
+    """Decode a base64url encoded JSON segment of a JWT"""
+    segment += b"=" * (-len(segment) % 4)
+    return json.loads(base64.urlsafe_b64decode(segment).decode())
+
+
+def get_unverified_jwt(access_token):
+    """Return the header and the payload of a JWT without verifying
+    its signature or claims, or (None, None) if the token is not a JWT
+
+    Parameters
+    ----------
+    access_token : str|bytes
+        access token as extracted from the HTTP Authorization header
+    """
+    if isinstance(access_token, str):
+        access_token = access_token.encode()
+    segments = access_token.split(b".")
+    if len(segments) != 3:
+        return None, None
+    try:
+        header = decode_jwt_segment(segments[0])
+        payload = decode_jwt_segment(segments[1])
+    except Exception:
+        return None, None
+    if not isinstance(header, dict) or not isinstance(payload, dict):
+        return None, None
+    return header, payload
+
+
+def intern_set(values):
+    """Return a frozenset of the values, the same instance for equal sets"""
+    values = frozenset(sys.intern(value) for value in values if value)
+    interned = _interned_sets.get(values)
+    if interned is None:
+        interned = values
+        if len(_interned_sets) < MAX_INTERNED_SETS:
+            _interned_sets[values] = values
+    return interned
+
+
+def get_scope_set(scope):
+    """Return a frozenset of scopes from a space separated string or a list"""
+    if not scope:
+        return intern_set(())
+    if isinstance(scope, str):
+        scope = scope.split()
+    return intern_set(scope)
+
+
+def get_audience_set(aud):
+    """Return a frozenset of audiences from an 'aud' claim, a string or a list"""
+    if not aud:
+        return intern_set(())
+    if isinstance(aud, str):
+        aud = [aud]
+    return intern_set(aud)
@@ -0,0 +1,154 @@
+import atexit
+import logging
+import queue
+import threading
+import time
+from django.conf import settings
+from django.db import close_old_connections, connections
+from .models import AccessToken, AccessTokenAudience
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class TokenWriter:
+    """Write-behind queue of validated access tokens
+
+    Tokens are stored in the database by a background thread with
+    bulk_create in batches of up to batch_size tokens, at least every
+    flush_interval seconds, so that database writes are not on the
+    latency path of a request. The in-process token cache answers for
+    tokens that have not been written yet.
+
+    Parameters
+    ----------
+    batch_size : int
+        maximum number of tokens written with a single bulk_create
+    flush_interval : float
+        maximum number of seconds a token waits in the queue
+    enabled : bool
+        if False, tokens are written synchronously by the caller
+    """
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, enabled=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, access_token, audiences=()):
+        """Queue an access token and its audiences for writing
+
+        Parameters
+        ----------
+        access_token : AccessToken
+            unsaved access token
+        audiences : list
+            audiences of the access token
+        """
+        if not self.enabled:
+            self.write([(access_token, audiences)])
+            return
+        self._queue.put((access_token, audiences))
+        if self._thread is None:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="mp-auth-token-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            batch = [item]
+            # The first token of a batch waits at most flush_interval seconds
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            close_old_connections()
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.warning("Could not write {} access tokens to the database: {}".format(len(batch), e))
+
+    def flush(self):
+        """Write all queued tokens in the calling thread"""
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if len(batch) == self.batch_size:
+                self.write(batch)
+                batch = []
+        if batch:
+            self.write(batch)
+        connections.close_all()
+
+    def write(self, batch):
+        """Store a batch of access tokens and their audiences
+
+        Tokens that are already in the database, e.g. because another worker
+        validated the same token, are skipped.
+        """
+        tokens = {}
+        for access_token, audiences in batch:
+            tokens.setdefault(access_token.access_token_hash, (access_token, audiences))
+        existing = set(AccessToken.objects.filter(
+                access_token_hash__in=tokens.keys()).values_list("access_token_hash", flat=True))
+        new_tokens = [tokens[h] for h in tokens if h not in existing]
+        if not new_tokens:
+            return
+
+        AccessToken.objects.bulk_create(
+                [access_token for access_token, _audiences in new_tokens], ignore_conflicts=True)
+        pks = dict(AccessToken.objects.filter(
+                access_token_hash__in=[access_token.access_token_hash for access_token, _audiences in new_tokens]
+        ).values_list("access_token_hash", "pk"))
+        audiences = []
+        for access_token, token_audiences in new_tokens:
+            access_token.pk = pks.get(access_token.access_token_hash)
+            if access_token.pk is None:
+                continue
+            audiences.extend(
+                AccessTokenAudience(access_token_id=access_token.pk, aud=aud) for aud in token_audiences)
+        if audiences:
+            AccessTokenAudience.objects.bulk_create(audiences)
+        logger.debug("{} new access tokens added to the database".format(len(new_tokens)))
+
+
+_token_writer = None
+_token_writer_lock = threading.Lock()
+
+
+def get_token_writer():
+    """Return the process-wide token writer
+
+    The writer is configured by the optional "WriteBehind" section of
+    MULTIPROVIDER_AUTH in settings.py, e.g.
+    "WriteBehind": {"enabled": True, "batch_size": 100, "flush_interval": 1.0}
+    """
+    global _token_writer
+    if _token_writer is None:
+        with _token_writer_lock:
+            if _token_writer is None:
+                conf = settings.MULTIPROVIDER_AUTH.get("WriteBehind", {})
+                _token_writer = TokenWriter(
+                        batch_size=conf.get("batch_size", DEFAULT_BATCH_SIZE),
+                        flush_interval=conf.get("flush_interval", DEFAULT_FLUSH_INTERVAL),
+                        enabled=conf.get("enabled", True))
+    return _token_writer
@@ -24,6 +24,7 @@ setup(name='multi-provider-auth',
       author_email='support@globus.org',
       packages=find_packages(),
       install_requires=install_requires,
+      extras_require={'async': ['httpx'], 'prometheus': ['prometheus_client']},
       include_package_data=True,
       keywords=['globus', 'django'],
       license='apache 2.0',